@@ -0,0 +1,175 @@
+"""
+Measures the event loop lag with 5000 simulated polling clients: the
+former synchronous set_handler_context/is_client_active/get_autoread
+queries against the write-behind Database with its writer thread.
+The poll interval is compressed to keep the run short.
+
+python3 benchmarks/bench_db_loop_lag.py
+"""
+
+import asyncio
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from json import dumps
+from sqlite3 import connect
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from yoyo import get_backend, read_migrations  # noqa: E402
+
+from context import Context  # noqa: E402
+from database import SELECT_CONTEXT, Database, map_context_to_row  # noqa: E402
+from samoware_api import SamowareClient  # noqa: E402
+
+CLIENTS_AMOUNT = 5000
+POLL_INTERVAL_SEC = 1.0
+DURATION_SEC = 10
+TICK_SEC = 0.005
+FLUSH_INTERVAL_SEC = 1.0
+MIGRATIONS_PATH = os.path.join(os.path.dirname(__file__), "..", "migrations")
+
+
+def legacy_map_context_to_dict(context: Context) -> dict:
+    return {
+        "login": context.samoware_login,
+        "ack_seq": context.samoware_client.ack_seq,
+        "command_id": context.samoware_client.command_id,
+        "cookies": context.samoware_client.get_cookies().output(header=""),
+        "last_revalidate": context.last_revalidate.isoformat(),
+        "request_id": context.samoware_client.request_id,
+        "session": context.samoware_client.session,
+        "rand": context.samoware_client.rand,
+    }
+
+
+class LegacyDatabase:
+    def __init__(self, path: str, contexts: list[Context]) -> None:
+        self.connection = connect(path, check_same_thread=False)
+        self.connection.execute(
+            "CREATE TABLE clients(telegram_id BLOB PRIMARY KEY, samoware_context BLOB,"
+            " password TEXT, autoread INTEGER DEFAULT TRUE NOT NULL)"
+        )
+        self.connection.executemany(
+            "INSERT INTO clients VALUES(?, ?, ?, ?)",
+            [
+                (
+                    context.telegram_id,
+                    dumps(legacy_map_context_to_dict(context)),
+                    None,
+                    True,
+                )
+                for context in contexts
+            ],
+        )
+        self.connection.commit()
+
+    def set_handler_context(self, context: Context) -> None:
+        self.connection.execute(
+            "UPDATE clients SET samoware_context=? WHERE telegram_id=?",
+            (dumps(legacy_map_context_to_dict(context)), context.telegram_id),
+        )
+        self.connection.commit()
+
+    def is_client_active(self, telegram_id: int) -> bool:
+        return (
+            self.connection.execute(
+                "SELECT COUNT(*) FROM clients WHERE telegram_id = ?", (telegram_id,)
+            ).fetchone()[0]
+            != 0
+        )
+
+    def get_autoread(self, telegram_id: int) -> bool:
+        return self.connection.execute(
+            "SELECT autoread FROM clients WHERE telegram_id=?", (telegram_id,)
+        ).fetchone()[0]
+
+
+def make_db(path: str, contexts: list[Context]) -> None:
+    backend = get_backend(f"sqlite:///{path}")
+    with backend.lock():
+        backend.apply_migrations(backend.to_apply(read_migrations(MIGRATIONS_PATH)))
+    connection = connect(path)
+    connection.executemany(
+        f"INSERT INTO clients(telegram_id, {SELECT_CONTEXT}) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [(context.telegram_id, *map_context_to_row(context)) for context in contexts],
+    )
+    connection.commit()
+    connection.close()
+
+
+async def poll(db, context: Context, stop_at: float) -> None:
+    await asyncio.sleep(random.uniform(0, POLL_INTERVAL_SEC))
+    while time.monotonic() < stop_at and db.is_client_active(context.telegram_id):
+        db.set_handler_context(context)
+        context.samoware_client.ack_seq += 1
+        if random.random() < 0.1:
+            db.get_autoread(context.telegram_id)
+        await asyncio.sleep(POLL_INTERVAL_SEC)
+
+
+async def flush_periodically(db: Database, stop_at: float) -> None:
+    while time.monotonic() < stop_at:
+        await asyncio.sleep(FLUSH_INTERVAL_SEC)
+        await db.flush()
+
+
+async def measure_lag(stop_at: float) -> list[float]:
+    lags = []
+    while time.monotonic() < stop_at:
+        start = time.monotonic()
+        await asyncio.sleep(TICK_SEC)
+        lags.append(time.monotonic() - start - TICK_SEC)
+    return lags
+
+
+async def run(db, contexts: list[Context]) -> list[float]:
+    stop_at = time.monotonic() + DURATION_SEC
+    tasks = [asyncio.create_task(poll(db, context, stop_at)) for context in contexts]
+    if isinstance(db, Database):
+        tasks.append(asyncio.create_task(flush_periodically(db, stop_at)))
+    lags = await measure_lag(stop_at)
+    await asyncio.gather(*tasks)
+    return lags
+
+
+def report(name: str, lags: list[float]) -> None:
+    lags = sorted(lags)
+    p50 = statistics.median(lags) * 1000
+    p99 = lags[int(len(lags) * 0.99)] * 1000
+    print(
+        f"{name:>14}: p50 {p50:7.2f} ms, p99 {p99:7.2f} ms, max {lags[-1] * 1000:7.2f} ms"
+    )
+
+
+async def main() -> None:
+    now = datetime.now(timezone.utc)
+    contexts = [
+        Context(
+            telegram_id,
+            f"login{telegram_id}",
+            SamowareClient(f"login{telegram_id}"),
+            now,
+        )
+        for telegram_id in range(CLIENTS_AMOUNT)
+    ]
+    with tempfile.TemporaryDirectory() as folder:
+        legacy_path = os.path.join(folder, "legacy.db")
+        legacy_db = LegacyDatabase(legacy_path, contexts)
+        report("legacy", await run(legacy_db, contexts))
+
+        path = os.path.join(folder, "database.db")
+        make_db(path, contexts)
+        db = Database(path)
+        db.open()
+        db.load_clients()
+        report("write-behind", await run(db, contexts))
+        await db.close()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,177 @@
+"""
+Compares the mail renderer with the former recursive BeautifulSoup walk.
+Checks that both produce identical output on the fixture corpus and
+measures them on a large generated newsletter.
+
+python3 benchmarks/bench_mail_renderer.py
+"""
+
+import html
+import logging as log
+import os
+import re
+import sys
+import timeit
+
+import bs4 as bs
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+import mail_renderer  # noqa: E402
+
+FIXTURES_PATH = os.path.join(os.path.dirname(__file__), "fixtures")
+NEWSLETTER_BLOCKS_AMOUNT = 300
+REPEATS = 5
+
+
+def legacy_html_element_to_text(element):
+    log.debug(f"converting html element to text: {element}")
+    if isinstance(element, bs.NavigableString):
+        return html.escape(
+            re.sub(
+                r" +",
+                " ",
+                str(element).replace("\r", "").strip("\n").replace("\n", " "),
+            )
+        )
+    elif isinstance(element, bs.Tag):
+        if element.name == "a" and "href" in element.attrs:
+            href = element["href"]
+            text = f'<a href="{href}">'
+            for child in element.children:
+                text += legacy_html_element_to_text(child)
+            text += "</a>"
+            return text
+        elif element.name == "style":
+            return ""
+        elif element.name == "br":
+            return "\n"
+        elif element.name == "hr":
+            return "\n----------\n"
+        elif element.name == "p":
+            text = ""
+            for child in element.children:
+                text += legacy_html_element_to_text(child)
+            return "\r" + text + "\r"
+        elif element.name == "div":
+            text = ""
+            for child in element.children:
+                text += legacy_html_element_to_text(child)
+            return "\n" + text + "\n"
+        elif element.name == "li":
+            text = ""
+            for child in element.children:
+                text += legacy_html_element_to_text(child)
+            return text + "\n"
+        elif element.name == "blockquote":
+            text = ""
+            for child in element.children:
+                text += legacy_html_element_to_text(child)
+            return "<blockquote>" + text.strip() + "</blockquote>"
+        else:
+            text = ""
+            for child in element.children:
+                text += legacy_html_element_to_text(child)
+            return text
+
+
+def legacy_render_mail(page: str) -> tuple[str, list[tuple[str, str]]]:
+    tree = bs.BeautifulSoup(page, "html.parser")
+    mailBodiesHtml = tree.findAll("div", {"class": "samoware-RFC822-body"})
+
+    text = ""
+    for mailBodyHtml in mailBodiesHtml:
+        log.debug("mail body: " + str(mailBodyHtml.encode()))
+        foundTextBeg = False
+        for element in mailBodyHtml.children:
+            if (
+                isinstance(element, bs.Tag)
+                and element.has_attr("class")
+                and "textBeg" in element["class"]
+            ):
+                foundTextBeg = True
+                log.debug("found textBeg")
+            if (
+                isinstance(element, bs.Tag)
+                and element.has_attr("class")
+                and "textEnd" in element["class"]
+            ):
+                log.debug("found textEnd")
+                break
+            if foundTextBeg:
+                text += legacy_html_element_to_text(element)
+
+    text = re.sub(r"(\r)+", "\r", text).strip()
+    text = re.sub(r"(\n)+", "\n", text).strip()
+    text = text.replace("\r", "\n\n")
+    text = text.replace("\n\xa0\n", "\n\n")
+    text = re.sub(r"(\n){2,}", "\n\n", text).strip()
+
+    attachments = [
+        (attachment_html["attachment-ref"], attachment_html["attachment-name"])
+        for attachment_html in tree.find_all("cg-message-attachment")
+    ]
+    return text, attachments
+
+
+def render_mail(page: str) -> tuple[str, list[tuple[str, str]]]:
+    rendered_mail = mail_renderer.render_mail(page)
+    return rendered_mail.text, rendered_mail.attachments
+
+
+def load_fixtures() -> dict[str, str]:
+    fixtures = {}
+    for name in sorted(os.listdir(FIXTURES_PATH)):
+        with open(os.path.join(FIXTURES_PATH, name), encoding="utf-8") as file:
+            fixtures[name] = file.read()
+    return fixtures
+
+
+def make_newsletter(fixtures: dict[str, str]) -> str:
+    newsletter = fixtures["newsletter.html"]
+    begin = newsletter.index('<div class="textBeg"></div>') + len(
+        '<div class="textBeg"></div>'
+    )
+    end = newsletter.index('<div class="textEnd"></div>')
+    block = newsletter[begin:end]
+    return newsletter[:begin] + block * NEWSLETTER_BLOCKS_AMOUNT + newsletter[end:]
+
+
+def main() -> None:
+    fixtures = load_fixtures()
+    for name, page in fixtures.items():
+        assert legacy_render_mail(page) == render_mail(page), name
+    print(f"identical output on {len(fixtures)} fixtures")
+
+    newsletter = make_newsletter(fixtures)
+    assert legacy_render_mail(newsletter) == render_mail(newsletter)
+    print(f"newsletter: {len(newsletter.encode()) / 1024:.0f} KiB")
+    results = {}
+    for name, function in (("legacy", legacy_render_mail), ("renderer", render_mail)):
+        results[name] = (
+            timeit.timeit(lambda: function(newsletter), number=REPEATS) / REPEATS
+        )
+        print(f"{name:>10}: {results[name] * 1000:.1f} ms per mail")
+    print(f"speedup: {results['legacy'] / results['renderer']:.2f}x")
+
+    try:
+        import lxml  # noqa: F401
+    except ImportError:
+        print("lxml is not installed, skipping the lxml parser")
+        return
+    os.environ["MAIL_HTML_PARSER"] = "lxml"
+    differences = [
+        name
+        for name, page in fixtures.items()
+        if legacy_render_mail(page) != render_mail(page)
+    ]
+    seconds = timeit.timeit(lambda: render_mail(newsletter), number=REPEATS) / REPEATS
+    print(
+        f"{'lxml':>10}: {seconds * 1000:.1f} ms per mail, "
+        f"speedup: {results['legacy'] / seconds:.2f}x, "
+        f"differs on fixtures: {differences}"
+    )
+
+
+if __name__ == "__main__":
+    main()
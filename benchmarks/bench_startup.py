@@ -0,0 +1,141 @@
+"""
+Tracks the time to the first longpoll of a cold start: a fresh
+interpreter imports the application, opens the database with 1000
+clients and starts their handlers. Telegram is not connected and the
+longpoll is stubbed, so only the local startup work is measured.
+
+python3 benchmarks/bench_startup.py
+"""
+
+import asyncio
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+
+START_TIME = time.perf_counter()
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "src")
+MIGRATIONS_PATH = os.path.join(SRC_PATH, "..", "migrations")
+CLIENTS_AMOUNT = 1000
+RUNS = 5
+FIRST_LONGPOLL_TARGET_SEC = 1.5
+LAZY_MODULES = ("bs4", "Crypto", "yoyo")
+
+
+async def run_child() -> None:
+    sys.path.insert(0, SRC_PATH)
+    import samowarium  # noqa: F401
+    from client_handler import ClientHandler
+    from const import DB_PATH
+    from database import Database
+    import samoware_api
+
+    imported_at = time.perf_counter()
+
+    async def longpoll_updates(self) -> bool:
+        samoware_api.first_longpoll_sent.set()
+        await asyncio.Event().wait()
+
+    async def send_message(*args) -> None:
+        pass
+
+    samoware_api.SamowareClient.longpoll_updates = longpoll_updates
+    db = Database(DB_PATH)
+    db.initialize()
+    handlers = []
+    for _, context in await db.get_all_clients():
+        handler = await ClientHandler.make_from_context(context, send_message, db)
+        await handler.start_handling()
+        handlers.append(handler)
+    await samoware_api.first_longpoll_sent.wait()
+    first_longpoll_at = time.perf_counter()
+
+    print(
+        json.dumps(
+            {
+                "imports": imported_at - START_TIME,
+                "first_longpoll": first_longpoll_at - START_TIME,
+                "eager_modules": [
+                    module for module in LAZY_MODULES if module in sys.modules
+                ],
+            }
+        )
+    )
+    for handler in handlers:
+        handler.polling_task.cancel()
+    await db.close()
+
+
+def make_db(folder: str) -> None:
+    sys.path.insert(0, SRC_PATH)
+    from datetime import datetime, timezone
+    from sqlite3 import connect
+
+    from yoyo import get_backend, read_migrations
+
+    from context import Context
+    from database import SELECT_CONTEXT, map_context_to_row
+    from samoware_api import SamowareClient
+
+    path = os.path.join(folder, "db", "database.db")
+    os.makedirs(os.path.dirname(path))
+    backend = get_backend(f"sqlite:///{path}")
+    with backend.lock():
+        backend.apply_migrations(backend.to_apply(read_migrations(MIGRATIONS_PATH)))
+    now = datetime.now(timezone.utc)
+    connection = connect(path)
+    connection.executemany(
+        f"INSERT INTO clients(telegram_id, {SELECT_CONTEXT}) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+        [
+            (
+                telegram_id,
+                *map_context_to_row(
+                    Context(
+                        telegram_id,
+                        f"login{telegram_id}",
+                        SamowareClient(f"login{telegram_id}"),
+                        now,
+                    )
+                ),
+            )
+            for telegram_id in range(CLIENTS_AMOUNT)
+        ],
+    )
+    connection.commit()
+    connection.close()
+    os.symlink(os.path.abspath(MIGRATIONS_PATH), os.path.join(folder, "migrations"))
+
+
+def main() -> None:
+    with tempfile.TemporaryDirectory() as folder:
+        make_db(folder)
+        results = []
+        for _ in range(RUNS):
+            output = subprocess.run(
+                [sys.executable, os.path.abspath(__file__), "--child"],
+                cwd=folder,
+                capture_output=True,
+                check=True,
+                text=True,
+            ).stdout
+            results.append(json.loads(output.splitlines()[-1]))
+
+    imports = statistics.median(result["imports"] for result in results)
+    first_longpoll = statistics.median(result["first_longpoll"] for result in results)
+    print(f"clients: {CLIENTS_AMOUNT}, runs: {RUNS}")
+    print(f"imports:        {imports * 1000:7.1f} ms")
+    print(f"first longpoll: {first_longpoll * 1000:7.1f} ms")
+    print(f"eagerly imported: {results[0]['eager_modules'] or 'none'}")
+    target = "met" if first_longpoll <= FIRST_LONGPOLL_TARGET_SEC else "MISSED"
+    print(f"target {FIRST_LONGPOLL_TARGET_SEC * 1000:.0f} ms: {target}")
+
+
+if __name__ == "__main__":
+    if "--child" in sys.argv:
+        asyncio.run(run_child())
+    else:
+        main()
@@ -0,0 +1,117 @@
+"""
+Compares the streaming XIMSS parser with the former
+ET.fromstring + findall path on a folderSync response with 300 reports.
+
+python3 benchmarks/bench_ximss_parser.py
+"""
+
+import html
+import os
+import sys
+import timeit
+import tracemalloc
+import xml.etree.ElementTree as ET
+from datetime import datetime
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), "..", "src"))
+
+from samoware_api import parse_mail_header  # noqa: E402
+import ximss  # noqa: E402
+
+REPORTS_AMOUNT = 300
+CHUNK_SIZE = ximss.STREAM_CHUNK_SIZE
+REPEATS = 50
+
+REPORT = (
+    '<folderReport folder="INBOX-MM-1" mode="added" UID="{uid}" id="7">'
+    "<FLAGS>Recent,Seen</FLAGS>"
+    '<INTERNALDATE localTime="20240905T101500">20240905T071500Z</INTERNALDATE>'
+    '<E-From realName="Деканат ИУ">dekanat@bmstu.ru</E-From>'
+    "<Subject>Расписание на неделю {uid}</Subject>"
+    '<E-To realName="Студент">student{uid}@student.bmstu.ru</E-To>'
+    "<SIZE>12345</SIZE>"
+    "<Message-ID>&lt;{uid}@bmstu.ru&gt;</Message-ID>"
+    "</folderReport>"
+)
+
+
+def make_response() -> bytes:
+    reports = "".join(REPORT.format(uid=uid) for uid in range(REPORTS_AMOUNT))
+    return f'<XIMSS respSeq="1">{reports}<response id="7"/></XIMSS>'.encode()
+
+
+def legacy_parse(data: bytes) -> list:
+    tree = ET.fromstring(data.decode())
+    headers = []
+    for element in tree.findall("folderReport"):
+        if element.attrib["mode"] == "added":
+            uid = element.attrib["UID"]
+            local_time = datetime.strptime(
+                element.find("INTERNALDATE").attrib["localTime"], "%Y%m%dT%H%M%S"
+            )
+            utc_time = datetime.strptime(
+                element.find("INTERNALDATE").text, "%Y%m%dT%H%M%SZ"
+            )
+            flags = element.find("FLAGS").text
+            from_mail = element.find("E-From").text
+            if "realName" in element.find("E-From").attrib:
+                from_name = element.find("E-From").attrib["realName"]
+            else:
+                from_name = element.find("E-From").text
+            if (
+                element.find("Subject") is not None
+                and element.find("Subject").text is not None
+            ):
+                subject = html.escape(element.find("Subject").text)
+            else:
+                subject = "Письмо без темы"
+            to = []
+            for el in element.findall("E-To"):
+                to.append((el.text, el.attrib.get("realName", el.text)))
+            headers.append(
+                (uid, flags, local_time, utc_time, from_mail, from_name, subject, to)
+            )
+    return headers
+
+
+def streaming_parse(data: bytes) -> list:
+    parser = ximss.XimssStreamParser()
+    headers = []
+    for shift in range(0, len(data), CHUNK_SIZE):
+        for event in parser.feed(data[shift : shift + CHUNK_SIZE]):
+            if isinstance(event, ximss.FolderReportEvent) and event.mode == "added":
+                headers.append(parse_mail_header(event.element))
+    for event in parser.close():
+        pass
+    return headers
+
+
+def peak_memory(function, data: bytes) -> int:
+    tracemalloc.start()
+    function(data)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return peak
+
+
+def main() -> None:
+    data = make_response()
+    legacy = legacy_parse(data)
+    streamed = streaming_parse(data)
+    assert [header[0] for header in legacy] == [header.uid for header in streamed]
+    assert [header[6] for header in legacy] == [header.subject for header in streamed]
+    assert [header[2:4] for header in legacy] == [
+        (header.local_time, header.utc_time) for header in streamed
+    ]
+
+    print(f"folderSync response: {REPORTS_AMOUNT} reports, {len(data)} bytes")
+    for name, function in (("legacy", legacy_parse), ("streaming", streaming_parse)):
+        seconds = timeit.timeit(lambda: function(data), number=REPEATS) / REPEATS
+        print(
+            f"{name:>10}: {seconds * 1000:.2f} ms per response, "
+            f"peak memory {peak_memory(function, data) / 1024:.0f} KiB"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,18 @@
+"""
+telegram attachments
+"""
+
+from yoyo import step
+
+__depends__ = {"20240903_01_ir7dx-autoread"}
+
+steps = [
+    step(
+        """
+        CREATE TABLE IF NOT EXISTS telegram_attachments(
+            digest TEXT PRIMARY KEY,
+            file_id TEXT NOT NULL
+        );
+        """
+    )
+]
@@ -0,0 +1,21 @@
+"""
+outbox
+"""
+
+from yoyo import step
+
+__depends__ = {"20241020_01_Qm3kT-telegram-attachments"}
+
+steps = [
+    step(
+        """
+        CREATE TABLE IF NOT EXISTS outbox(
+            id TEXT PRIMARY KEY,
+            telegram_id INTEGER NOT NULL,
+            message TEXT NOT NULL,
+            format TEXT,
+            attachments TEXT
+        );
+        """
+    )
+]
@@ -0,0 +1,49 @@
+"""
+split samoware context
+"""
+
+from yoyo import step
+
+__depends__ = {"20241021_01_Hx8pW-outbox"}
+
+steps = [
+    step(
+        """
+        CREATE TABLE clients_new(
+            telegram_id BLOB PRIMARY KEY,
+            login TEXT NOT NULL,
+            session TEXT NOT NULL,
+            ack_seq INTEGER NOT NULL,
+            request_id INTEGER NOT NULL,
+            command_id INTEGER NOT NULL,
+            rand INTEGER NOT NULL,
+            cookies TEXT NOT NULL,
+            last_revalidate TEXT NOT NULL,
+            password TEXT,
+            autoread INTEGER DEFAULT TRUE NOT NULL
+        );
+        """
+    ),
+    step(
+        """
+        INSERT INTO clients_new
+        SELECT
+            telegram_id,
+            json_extract(samoware_context, '$.login'),
+            json_extract(samoware_context, '$.session'),
+            json_extract(samoware_context, '$.ack_seq'),
+            json_extract(samoware_context, '$.request_id'),
+            json_extract(samoware_context, '$.command_id'),
+            json_extract(samoware_context, '$.rand'),
+            json_extract(samoware_context, '$.cookies'),
+            json_extract(samoware_context, '$.last_revalidate'),
+            password,
+            autoread
+        FROM clients;
+        """
+    ),
+    step("DROP TABLE clients;"),
+    step("ALTER TABLE clients_new RENAME TO clients;"),
+    step("CREATE INDEX clients_last_revalidate ON clients(last_revalidate);"),
+    step("CREATE INDEX clients_stat ON clients((password IS NOT NULL), autoread);"),
+]
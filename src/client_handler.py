@@ -1,22 +1,26 @@
 import asyncio
 import logging as log
-from datetime import datetime, timedelta, timezone
+from datetime import datetime, timezone
+from functools import partial
 import re
-from typing import Self
+from typing import Awaitable, Callable, Self
 
 import aiohttp
 from context import Context
 
 from const import (
     HTML_FORMAT,
-    HTTP_RETRY_DELAY_SEC,
+    LOGIN_MAX_ATTEMPTS,
     MARKDOWN_FORMAT,
 )
 from database import Database
-import samoware_api
+from mail_cache import mail_cache
+from retry import SAMOWARE_RETRY_POLICIES, Retry, make_retry_budget
+from revalidation import revalidation_scheduler
 from samoware_api import (
     Mail,
     UnauthorizedError,
+    samoware_health,
 )
 from util import MessageSender
 from metrics import (
@@ -29,7 +33,6 @@ from metrics import (
     incoming_letter_metric,
 )
 
-REVALIDATE_INTERVAL = timedelta(hours=5)
 SESSION_TOKEN_PATTERN = re.compile("^[0-9]{6}-[a-zA-Z0-9]{20}$")
 
 SUCCESSFUL_LOGIN_PROMPT = (
@@ -39,9 +42,23 @@ CAN_NOT_REVALIDATE_PROMPT = "Невозможно продлить сессию
 SESSION_EXPIRED_PROMPT = "Сессия доступа к почте истекла. Для продолжения работы необходима повторная авторизация\n/login _логин_ _пароль_"
 CAN_NOT_RELOGIN_PROMPT = "Ошибка при автоматической повторной авторизации, невозможно продлить сессию. Для продолжения работы необходима авторизация\n/login _логин_ _пароль_"
 WRONG_CREDS_PROMPT = "Неверный логин или пароль."
+SAMOWARE_UNAVAILABLE_PROMPT = (
+    "Самовар сейчас не отвечает. Попробуйте авторизоваться позже."
+)
 HANDLER_IS_ALREADY_WORKED_PROMPT = "Доступ уже был выдан."
 HANDLER_IS_ALREADY_SHUTTED_DOWN_PROMPT = "Доступ уже был отозван."
 
+# states of the restored sessions
+SESSION_ALIVE = "alive"
+SESSION_NEEDS_RELOGIN = "needs_relogin"
+SESSION_NEEDS_USER = "needs_user"
+SESSION_UNKNOWN = "unknown"
+
+# login results
+LOGIN_SUCCESSFUL = "successful"
+LOGIN_UNAUTHORIZED = "unauthorized"
+LOGIN_GIVEN_UP = "given_up"
+
 
 class ClientHandler:
     def __init__(
@@ -53,6 +70,10 @@ class ClientHandler:
         self.message_sender = message_sender
         self.db = db
         self.context = context
+        self.polling_task: asyncio.Task | None = None
+        self.retry_budget = make_retry_budget()
+        # set by the revalidation scheduler
+        self.revalidation_due = False
 
     @classmethod
     async def make_new(
@@ -62,7 +83,12 @@ class ClientHandler:
         samoware_password: str,
         message_sender: MessageSender,
         db: Database,
+        admit: Callable[[Callable[[], Awaitable[str]]], Awaitable[str]],
     ) -> Self | None:
+        """
+        Logs the new client in through `admit`, which may time out,
+        and saves it after the admitted part is over.
+        """
         if db.is_client_active(telegram_id):
             await message_sender(
                 telegram_id, HANDLER_IS_ALREADY_WORKED_PROMPT, MARKDOWN_FORMAT
@@ -71,12 +97,22 @@ class ClientHandler:
         handler = ClientHandler(
             message_sender, db, Context(telegram_id, samoware_login)
         )
-        is_successful_login = await handler.login(samoware_password)
-        login_metric.labels(is_successful=is_successful_login).inc()
-        if not is_successful_login:
-            await message_sender(telegram_id, WRONG_CREDS_PROMPT, MARKDOWN_FORMAT)
+        try:
+            login_result = await admit(partial(handler.login, samoware_password))
+        except (asyncio.CancelledError, TimeoutError):
+            await handler.context.samoware_client.close()
+            raise
+        login_metric.labels(is_successful=login_result == LOGIN_SUCCESSFUL).inc()
+        if login_result != LOGIN_SUCCESSFUL:
+            await handler.context.samoware_client.close()
+            prompt = (
+                WRONG_CREDS_PROMPT
+                if login_result == LOGIN_UNAUTHORIZED
+                else SAMOWARE_UNAVAILABLE_PROMPT
+            )
+            await message_sender(telegram_id, prompt, MARKDOWN_FORMAT)
             return None
-        db.add_client(telegram_id, handler.context)
+        await db.add_client(telegram_id, handler.context)
         await message_sender(telegram_id, SUCCESSFUL_LOGIN_PROMPT, MARKDOWN_FORMAT)
         return handler
 
@@ -94,6 +130,8 @@ class ClientHandler:
         return self.polling_task
 
     async def stop_handling(self) -> None:
+        if self.polling_task is None:
+            return
         if not (self.polling_task.cancelled() or self.polling_task.done()):
             self.polling_task.cancel()
             logout_metric.inc()
@@ -101,131 +139,181 @@ class ClientHandler:
 
     async def polling(self) -> None:
         try:
-            retry_count = 0
+            retry = Retry("polling", SAMOWARE_RETRY_POLICIES, self.retry_budget)
             log.info(f"longpolling for {self.context.samoware_login} is started")
+            revalidation_scheduler.schedule(self)
 
+            client = self.context.samoware_client
             while self.db.is_client_active(self.context.telegram_id):
                 try:
-                    polling_context = self.context.polling_context
+                    # during an outage the pollers wait here instead of retrying
+                    await samoware_health.wait_available()
                     self.db.set_handler_context(self.context)
-                    (polling_result, polling_context) = (
-                        await samoware_api.longpoll_updates(polling_context)
-                    )
-                    if samoware_api.has_updates(polling_result):
-                        (mails, polling_context) = await samoware_api.get_new_mails(
-                            polling_context
-                        )
+                    has_updates = await client.longpoll_updates()
+                    samoware_health.record_success()
+                    if has_updates:
+                        mails = await client.get_new_mails()
                         for mail_header in mails:
                             incoming_letter_metric.inc()
                             log.info(f"new mail for {self.context.samoware_login}")
                             log.debug(f"email flags: {mail_header.flags}")
-                            mail_body = await samoware_api.get_mail_body_by_id(
-                                polling_context, mail_header.uid
+                            mail_body = await mail_cache.get_or_load(
+                                mail_header,
+                                partial(client.get_mail_body_by_id, mail_header.uid),
                             )
                             await self.forward_mail(Mail(mail_header, mail_body))
+                            # a mark waits in the queue of the client, so if a later
+                            # letter fails, it still goes with the next sync request
                             if self.db.get_autoread(self.context.telegram_id):
-                                polling_context = await samoware_api.mark_as_read(
-                                    polling_context, mail_header.uid
-                                )
-                    self.context.polling_context = polling_context
-                    if datetime.astimezone(
-                        self.context.last_revalidate + REVALIDATE_INTERVAL,
-                        timezone.utc,
-                    ) < datetime.now(timezone.utc):
-                        is_successful_revalidation = await self.revalidate()
+                                client.queue_mark_as_read([mail_header.uid])
+                        await client.flush()
+                    if self.revalidation_due:
+                        is_successful_revalidation = (
+                            await revalidation_scheduler.revalidate(self)
+                        )
                         revalidation_metric.labels(
                             is_successful=is_successful_revalidation
                         ).inc()
                         if not is_successful_revalidation:
                             await self.can_not_revalidate()
-                            self.db.remove_client(self.context.telegram_id)
+                            await self.db.remove_client(self.context.telegram_id)
                             forced_logout_metric.inc()
                             return
-                    retry_count = 0
+                        revalidation_scheduler.schedule(self)
+                    retry.reset()
                 except asyncio.CancelledError:
                     return
                 except UnauthorizedError as error:
                     client_handler_error_metric.labels(type=type(error).__name__).inc()
                     log.info(f"session for {self.context.samoware_login} expired")
-                    samoware_password = self.db.get_password(self.context.telegram_id)
-                    if samoware_password is None:
-                        await self.session_has_expired()
-                        self.db.remove_client(self.context.telegram_id)
-                        forced_logout_metric.inc()
-                        return
-                    is_successful_relogin = await self.login(samoware_password)
-                    relogin_metric.labels(is_successful=is_successful_relogin).inc()
-                    if not is_successful_relogin:
-                        await self.can_not_relogin()
-                        self.db.remove_client(self.context.telegram_id)
-                        forced_logout_metric.inc()
+                    relogin_result = await self.relogin()
+                    if relogin_result == LOGIN_UNAUTHORIZED:
                         return
+                    if relogin_result == LOGIN_GIVEN_UP:
+                        # the client is kept, the next poll tries to relogin again
+                        await self.wait_retry(retry, error)
+                        continue
+                    revalidation_scheduler.schedule(self)
                 except (
                     aiohttp.ClientOSError
                 ) as error:  # unknown source error https://github.com/aio-libs/aiohttp/issues/6912
                     log.warning(
-                        f"retry_count={retry_count}. ClientOSError. Probably Broken pipe. Retrying in {HTTP_RETRY_DELAY_SEC} seconds. {str(error)}"
+                        f"retry_count={retry.attempts}. ClientOSError. Probably Broken pipe. {str(error)}"
                     )
                     client_handler_error_metric.labels(type=type(error).__name__).inc()
-                    retry_count += 1
-                    await asyncio.sleep(HTTP_RETRY_DELAY_SEC)
+                    await self.wait_retry(retry, error)
                 except Exception as error:
                     log.exception("exception in client_handler")
-                    log.warning(
-                        f"retry_count={retry_count}. Retrying longpolling for {self.context.samoware_login} in {HTTP_RETRY_DELAY_SEC} seconds..."
-                    )
                     client_handler_error_metric.labels(type=type(error).__name__).inc()
-                    retry_count += 1
-                    await asyncio.sleep(HTTP_RETRY_DELAY_SEC)
+                    await self.wait_retry(retry, error)
         finally:
+            revalidation_scheduler.remove(self)
+            await self.context.samoware_client.close()
             log.info(f"longpolling for {self.context.samoware_login} stopped")
 
-    async def login(self, samoware_password: str) -> bool:
+    async def warm_up(self) -> str:
+        """
+        Checks the restored session before the polling starts.
+        The clients which can not be logged in again are logged out here.
+        """
+        try:
+            await self.context.samoware_client.validate_session()
+            return SESSION_ALIVE
+        except UnauthorizedError:
+            log.info(f"restored session for {self.context.samoware_login} expired")
+        except Exception:
+            # the polling retries it with the usual policy
+            log.exception(
+                f"can not validate the session for {self.context.samoware_login}"
+            )
+            return SESSION_UNKNOWN
+        if self.db.has_password(self.context.telegram_id):
+            return SESSION_NEEDS_RELOGIN
+        await self.session_has_expired()
+        await self.db.remove_client(self.context.telegram_id)
+        forced_logout_metric.inc()
+        return SESSION_NEEDS_USER
+
+    async def relogin(self) -> str:
+        """
+        Logs in with the saved password, logs the client out if the
+        password is rejected. A given up relogin keeps the client.
+        """
+        samoware_password = (
+            await self.db.get_password(self.context.telegram_id)
+            if self.db.has_password(self.context.telegram_id)
+            else None
+        )
+        if samoware_password is None:
+            await self.session_has_expired()
+            await self.db.remove_client(self.context.telegram_id)
+            forced_logout_metric.inc()
+            return LOGIN_UNAUTHORIZED
+        login_result = await self.login(samoware_password)
+        relogin_metric.labels(is_successful=login_result == LOGIN_SUCCESSFUL).inc()
+        if login_result == LOGIN_UNAUTHORIZED:
+            await self.can_not_relogin()
+            await self.db.remove_client(self.context.telegram_id)
+            forced_logout_metric.inc()
+        return login_result
+
+    async def login(self, samoware_password: str) -> str:
         log.debug("trying to login")
-        retry_count = 0
+        # a login is awaited by the user or by the polling, so it gives up
+        retry = Retry(
+            "login", SAMOWARE_RETRY_POLICIES, self.retry_budget, LOGIN_MAX_ATTEMPTS
+        )
         while True:
             try:
-                polling_context = await samoware_api.login(
-                    self.context.samoware_login, samoware_password
-                )
-                polling_context = await samoware_api.set_session_info(polling_context)
-                polling_context = await samoware_api.open_inbox(polling_context)
-                self.context.polling_context = polling_context
+                await samoware_health.wait_available()
+                client = self.context.samoware_client
+                await client.login(samoware_password)
+                await client.setup_session()
                 self.context.last_revalidate = datetime.now(timezone.utc)
-                self.db.set_handler_context(self.context)
+                await self.db.save_handler_context(self.context)
                 log.info(f"successful login for user {self.context.samoware_login}")
-                return True
+                return LOGIN_SUCCESSFUL
             except UnauthorizedError as error:
                 log.info(f"unsuccessful login for user {self.context.samoware_login}")
                 client_handler_error_metric.labels(type=type(error).__name__).inc()
-                return False
+                return LOGIN_UNAUTHORIZED
             except asyncio.CancelledError:
                 log.info("login cancelled")
-                return False
+                raise
             except Exception as error:
-                log.exception(
-                    f"retry_count={retry_count}. exception on login. retrying in {HTTP_RETRY_DELAY_SEC}..."
-                )
+                log.exception(f"retry_count={retry.attempts}. exception on login")
                 client_handler_error_metric.labels(type=type(error).__name__).inc()
-                retry_count += 1
-                await asyncio.sleep(HTTP_RETRY_DELAY_SEC)
+                if not await self.wait_retry(retry, error):
+                    log.warning(
+                        f"login for user {self.context.samoware_login} is given up after {retry.attempts} attempts"
+                    )
+                    return LOGIN_GIVEN_UP
+
+    async def wait_retry(self, retry: Retry, error: Exception) -> bool:
+        """
+        Waits before the next attempt, returns False to give up.
+        """
+        samoware_health.record_error(error)
+        # a tripped breaker parks the handler before its next request
+        if not samoware_health.is_available():
+            return True
+        delay = retry.next_delay(error)
+        if delay is None:
+            return False
+        log.info(
+            f"retrying {retry.operation} for {self.context.samoware_login} in {delay:.1f} seconds..."
+        )
+        await asyncio.sleep(delay)
+        return True
 
     async def revalidate(self) -> bool:
         log.debug("trying to revalidate")
         try:
-            polling_context = await samoware_api.revalidate(
-                self.context.samoware_login, self.context.polling_context.session
-            )
-            if polling_context is None:
-                log.info(
-                    f"unsuccessful revalidation for user {self.context.samoware_login}"
-                )
-                return False
-            polling_context = await samoware_api.set_session_info(polling_context)
-            polling_context = await samoware_api.open_inbox(polling_context)
-            self.context.polling_context = polling_context
+            client = self.context.samoware_client
+            await client.revalidate()
+            await client.setup_session()
             self.context.last_revalidate = datetime.now(timezone.utc)
-            self.db.set_handler_context(self.context)
+            await self.db.save_handler_context(self.context)
             log.info(f"successful revalidation for user {self.context.samoware_login}")
             return True
         except UnauthorizedError as error:
@@ -261,11 +349,10 @@ class ClientHandler:
 
         mail_text = f'{datetime.strftime(mail.header.local_time, "%d.%m.%Y %H:%M")}\n\nОт кого: {from_str}\n\nКому: {to_str}\n\n<b>{mail.header.subject}</b>\n\n{mail.body.text}'
 
-        asyncio.create_task(
-            self.message_sender(
-                self.context.telegram_id,
-                mail_text,
-                HTML_FORMAT,
-                mail.body.attachments if len(mail.body.attachments) > 0 else None,
-            )
+        # waits while the delivery queue is full
+        await self.message_sender(
+            self.context.telegram_id,
+            mail_text,
+            HTML_FORMAT,
+            mail.body.attachments if len(mail.body.attachments) > 0 else None,
         )
@@ -6,6 +6,66 @@ HTTP_TOTAL_LONGPOLL_TIMEOUT_SEC = 60
 HTTP_RETRY_DELAY_SEC = 10
 TELEGRAM_SEND_RETRY_DELAY_SEC = 2
 
+# retries
+RETRY_TIMEOUT_DELAY_SEC = 2
+RETRY_CONNECTION_DELAY_SEC = 1
+RETRY_MAX_DELAY_SEC = 5 * 60
+RETRY_BUDGET_SIZE = 30  # retries of one client within the window
+RETRY_BUDGET_WINDOW_SEC = 10 * 60
+LOGIN_MAX_ATTEMPTS = 5
+
+# login admission
+LOGIN_CONCURRENCY = 20
+LOGIN_TIMEOUT_SEC = 2 * 60
+
+# telegram delivery
+TELEGRAM_GLOBAL_RATE = 30  # bot api calls per second
+TELEGRAM_GLOBAL_BURST = 30
+TELEGRAM_CHAT_RATE = 1  # bot api calls per second to one chat
+TELEGRAM_CHAT_BURST = 3
+TELEGRAM_DELIVERY_QUEUE_SIZE = 1000
+
+# samoware outage detection
+SAMOWARE_HEALTH_WINDOW_SEC = 30
+SAMOWARE_HEALTH_MIN_FAILURES = 10
+SAMOWARE_HEALTH_FAILURE_RATIO = 0.5
+SAMOWARE_HEALTH_PROBE_DELAY_SEC = 5
+SAMOWARE_HEALTH_PROBE_MAX_DELAY_SEC = 5 * 60
+SAMOWARE_HEALTH_RELEASE_SPREAD_SEC = 30
+
+# http pool
+HTTP_POOL_LIMIT = 0  # no total limit, every client keeps a longpoll connection
+HTTP_POOL_LIMIT_PER_HOST = 10000
+HTTP_POOL_KEEPALIVE_TIMEOUT_SEC = 60
+HTTP_POOL_DNS_CACHE_TTL_SEC = 5 * 60
+
+# attachments
+ATTACHMENT_DOWNLOADS_LIMIT = 16
+ATTACHMENT_CHUNK_SIZE = 64 * 1024
+ATTACHMENT_SPOOL_MEMORY_SIZE = 1024 * 1024
+ATTACHMENTS_IN_FLIGHT_LIMIT_MB = 256
+
+# mail rendering
+MAIL_RENDER_WORKERS = 2
+MAIL_RENDER_QUEUE_SIZE_PER_WORKER = 4
+
+# mail cache
+MAIL_CACHE_SIZE = 256
+MAIL_CACHE_TTL_SEC = 60 * 60
+MAIL_CACHE_MEMORY_LIMIT_MB = 64
+
+# startup ramp
+STARTUP_RAMP_RATE = 50  # started handlers per second
+STARTUP_RAMP_JITTER_SEC = 1
+STARTUP_RAMP_CONCURRENCY = 100
+STARTUP_RELOGIN_CONCURRENCY = 10
+
+# session revalidation
+REVALIDATE_INTERVAL_SEC = 5 * 60 * 60
+REVALIDATE_JITTER_SEC = 30 * 60
+REVALIDATE_OVERDUE_SPREAD_SEC = 10 * 60
+REVALIDATE_CONCURRENCY = 10
+
 # tg message formats
 HTML_FORMAT = "html"
 MARKDOWN_FORMAT = "markdown"
@@ -13,7 +73,19 @@ MARKDOWN_FORMAT = "markdown"
 # db
 DB_FOLDER_PATH = "db"
 DB_PATH = f"{DB_FOLDER_PATH}/database.db"
+MIGRATIONS_FOLDER_PATH = "migrations"
+DB_FLUSH_INTERVAL_SEC = 5
+DB_MAX_STALENESS_SEC = 30
+DB_READERS = 2
+DB_CACHE_SIZE_KB = 16 * 1024
+DB_STATEMENTS_CACHE_SIZE = 64
 
 # logs
 LOGGER_FOLDER_PATH = "logs"
 LOGGER_PATH = f"{LOGGER_FOLDER_PATH}/samowarium.log"
+IMPORTTIME_LOG_PATH = f"{LOGGER_FOLDER_PATH}/importtime.log"
+
+# startup profile
+PROFILE_STARTUP_ARG = "--profile-startup"
+PROFILE_STARTUP_LONGPOLL_TIMEOUT_SEC = 60
+PROFILE_STARTUP_IMPORTS_AMOUNT = 15
@@ -1,5 +1,5 @@
 from datetime import datetime, timezone
-from samoware_api import SamowarePollingContext
+from samoware_api import SamowareClient
 
 
 class Context:
@@ -7,14 +7,14 @@ class Context:
         self,
         telegram_id: int,
         samoware_login: str,
-        polling_context: SamowarePollingContext | None = None,
+        samoware_client: SamowareClient | None = None,
         last_revalidation: datetime | None = None,
     ) -> None:
         self.telegram_id = telegram_id
         self.samoware_login = samoware_login
-        self.polling_context = polling_context
-        if self.polling_context is None:
-            self.polling_context = SamowarePollingContext()
+        self.samoware_client = samoware_client
+        if self.samoware_client is None:
+            self.samoware_client = SamowareClient(samoware_login)
         self.last_revalidate = last_revalidation
         if self.last_revalidate is None:
             self.last_revalidate = datetime.now(timezone.utc)
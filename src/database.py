@@ -1,213 +1,457 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
 from http.cookies import SimpleCookie
 import logging as log
-from sqlite3 import connect
+from sqlite3 import Connection, connect
+import threading
+import time
 from json import dumps, loads
-from typing import Self
-import dateutil.parser
+from typing import Callable, Self, TypeVar
 from encryption import Encrypter
-from samoware_api import SamowarePollingContext
+from samoware_api import SamowareClient
 from context import Context
+import env
+import metrics
+from const import DB_CACHE_SIZE_KB, DB_READERS, DB_STATEMENTS_CACHE_SIZE
 import util
 
+T = TypeVar("T")
 
-def map_context_to_dict(context: Context) -> dict:
-    return {
-        "login": context.samoware_login,
-        "ack_seq": context.polling_context.ack_seq,
-        "command_id": context.polling_context.command_id,
-        "cookies": context.polling_context.cookies.output(header=""),
-        "last_revalidate": context.last_revalidate.isoformat(),
-        "request_id": context.polling_context.request_id,
-        "session": context.polling_context.session,
-        "rand": context.polling_context.rand,
-    }
 
+CONTEXT_COLUMNS = (
+    "login",
+    "session",
+    "ack_seq",
+    "request_id",
+    "command_id",
+    "rand",
+    "cookies",
+    "last_revalidate",
+)
+SELECT_CONTEXT = ", ".join(CONTEXT_COLUMNS)
+UPDATE_CONTEXT = ", ".join(f"{column}=?" for column in CONTEXT_COLUMNS)
 
-def map_context_from_dict(d: dict, telegram_id: int) -> Context:
+
+def map_context_to_row(context: Context) -> tuple:
+    return (
+        context.samoware_login,
+        context.samoware_client.session,
+        context.samoware_client.ack_seq,
+        context.samoware_client.request_id,
+        context.samoware_client.command_id,
+        context.samoware_client.rand,
+        context.samoware_client.get_cookies().output(header=""),
+        context.last_revalidate.isoformat(),
+    )
+
+
+def map_context_from_row(row: tuple, telegram_id: int) -> Context:
+    (
+        login,
+        session,
+        ack_seq,
+        request_id,
+        command_id,
+        rand,
+        cookies_encoded,
+        last_revalidate,
+    ) = row
     cookies = SimpleCookie()
-    cookies.load(d["cookies"])
+    cookies.load(cookies_encoded)
     return Context(
-        polling_context=SamowarePollingContext(
-            ack_seq=d["ack_seq"],
-            command_id=d["command_id"],
+        samoware_client=SamowareClient(
+            login=login,
+            ack_seq=ack_seq,
+            command_id=command_id,
             cookies=cookies,
-            rand=d["rand"],
-            session=d["session"],
-            request_id=d["request_id"],
+            rand=rand,
+            session=session,
+            request_id=request_id,
         ),
-        last_revalidation=dateutil.parser.isoparse(d["last_revalidate"]),
-        samoware_login=d["login"],
+        last_revalidation=datetime.fromisoformat(last_revalidate),
+        samoware_login=login,
         telegram_id=telegram_id,
     )
 
 
+class ClientSettings:
+    def __init__(self, autoread: bool = True, has_password: bool = False) -> None:
+        self.autoread = autoread
+        self.has_password = has_password
+
+
+def open_connection(path: str) -> Connection:
+    # the statements are prepared once per connection and reused from the cache
+    connection = connect(
+        path, check_same_thread=False, cached_statements=DB_STATEMENTS_CACHE_SIZE
+    )
+    connection.execute("PRAGMA journal_mode=WAL")
+    connection.execute("PRAGMA synchronous=NORMAL")
+    connection.execute(f"PRAGMA cache_size=-{DB_CACHE_SIZE_KB}")
+    connection.execute("PRAGMA temp_store=MEMORY")
+    return connection
+
+
 class Database:
+    """
+    SQLite is never touched from the event loop: the writes are done by
+    one writer thread, the reads by a few reader threads with their own
+    connections, which WAL lets run next to the writer.
+    """
+
     def __init__(self, DB_PATH: str) -> None:
         self.path = DB_PATH
+        self.connection: Connection | None = None
+        self.writer: ThreadPoolExecutor | None = None
+        self.readers: ThreadPoolExecutor | None = None
+        self.reader_connections: list[Connection] = []
+        self.local = threading.local()
+        # outbox changes and polling contexts are written by the next flush
+        self.outbox_inserts: dict[str, tuple] = {}
+        self.outbox_deletes: list[str] = []
+        self.dirty_contexts: dict[int, tuple] = {}
+        self.dirty_since: float | None = None
+        self.max_staleness = env.get_db_max_staleness()
+        self.flush_task: asyncio.Task | None = None
+        # active clients, kept in sync by the write methods
+        self.clients: dict[int, ClientSettings] = {}
+        self.removal_listeners: list[Callable[[int], None]] = []
 
-    def __enter__(self) -> Self:
+    async def __aenter__(self) -> Self:
         self.initialize()
         return self
 
-    def __exit__(self, *args) -> None:
-        self.close()
+    async def __aexit__(self, *args) -> None:
+        await self.close()
 
     def is_open(self) -> bool:
-        try:
-            self.connection.cursor()
-            return True
-        except:
-            return False
+        return self.connection is not None
 
     def initialize(self) -> None:
         log.debug("initializing db...")
-        self.connection = connect(self.path, check_same_thread=False)
         self.encrypter = Encrypter()
-        util.run_migrations()
+        util.run_migrations(self.path)
+        self.open()
+        self.load_clients()
         log.info("db has initialized")
 
-    def close(self) -> None:
+    def open(self) -> None:
+        self.connection = open_connection(self.path)
+        self.writer = ThreadPoolExecutor(max_workers=1, thread_name_prefix="db_writer")
+        self.readers = ThreadPoolExecutor(
+            max_workers=DB_READERS, thread_name_prefix="db_reader"
+        )
+
+    async def write(self, query: Callable[[Connection], T]) -> T:
+        return await asyncio.get_running_loop().run_in_executor(
+            self.writer, query, self.connection
+        )
+
+    async def read(self, query: Callable[[Connection], T]) -> T:
+        return await asyncio.get_running_loop().run_in_executor(
+            self.readers, self.run_read, query
+        )
+
+    def run_read(self, query: Callable[[Connection], T]) -> T:
+        connection = getattr(self.local, "connection", None)
+        if connection is None:
+            connection = open_connection(self.path)
+            self.local.connection = connection
+            self.reader_connections.append(connection)
+        return query(connection)
+
+    def load_clients(self) -> None:
+        self.clients = {
+            telegram_id: ClientSettings(bool(autoread), bool(has_password))
+            for telegram_id, autoread, has_password in self.connection.execute(
+                "SELECT telegram_id, autoread, password IS NOT NULL FROM clients"
+            ).fetchall()
+        }
+        log.debug(f"loaded {len(self.clients)} clients")
+
+    def add_removal_listener(self, listener: Callable[[int], None]) -> None:
+        self.removal_listeners.append(listener)
+
+    async def close(self) -> None:
         log.debug("trying to close database")
         if self.connection is None:
             raise RuntimeError("can not close an uninitialized database")
+        await self.flush()
+        self.readers.shutdown()
+        self.writer.shutdown()
+        for connection in self.reader_connections:
+            connection.close()
         self.connection.close()
+        self.connection = None
         log.info("database was closed")
 
-    def add_client(self, telegram_id: int, context: Context) -> None:
-        context_encoded = dumps(map_context_to_dict(context))
+    async def add_client(self, telegram_id: int, context: Context) -> None:
+        self.dirty_contexts.pop(telegram_id, None)
+        row = map_context_to_row(context)
 
-        self.connection.execute(
-            "INSERT INTO clients VALUES(?, ?, ?, ?)",
-            (telegram_id, context_encoded, None, True),
-        )
-        self.connection.commit()
+        def insert(connection: Connection) -> None:
+            connection.execute(
+                f"INSERT INTO clients(telegram_id, {SELECT_CONTEXT}) VALUES(?, ?, ?, ?, ?, ?, ?, ?, ?)",
+                (telegram_id, *row),
+            )
+            connection.commit()
+
+        await self.write(insert)
+        self.clients[telegram_id] = ClientSettings()
         log.debug(f"client {telegram_id} has inserted")
 
-    def set_password(self, telegram_id: int, password: str) -> None:
-        self.connection.execute(
-            "UPDATE clients SET password=? WHERE telegram_id=?",
-            (self.encrypter.encrypt(password), telegram_id),
-        )
-        self.connection.commit()
+    async def set_password(self, telegram_id: int, password: str) -> None:
+        def update(connection: Connection) -> None:
+            connection.execute(
+                "UPDATE clients SET password=? WHERE telegram_id=?",
+                (self.encrypter.encrypt(password), telegram_id),
+            )
+            connection.commit()
+
+        await self.write(update)
+        if telegram_id in self.clients:
+            self.clients[telegram_id].has_password = True
         log.debug(f"set password for the client {telegram_id}")
 
     def set_handler_context(self, context: Context) -> None:
-        telegram_id = context.telegram_id
-        context_encoded = dumps(map_context_to_dict(context))
-        self.connection.execute(
-            "UPDATE clients SET samoware_context=? WHERE telegram_id=?",
-            (context_encoded, telegram_id),
+        """
+        Marks the context as dirty, it is written by the next flush.
+        The context is copied now, so a flush never saves an ack_seq
+        of the letters which have not reached the outbox yet.
+        """
+        self.dirty_contexts[context.telegram_id] = map_context_to_row(context)
+        if self.dirty_since is None:
+            self.dirty_since = time.monotonic()
+        elif (
+            time.monotonic() - self.dirty_since > self.max_staleness
+            and self.flush_task is None
+        ):
+            log.warning("dirty contexts are too stale, flushing them now")
+            self.flush_task = asyncio.create_task(self.flush())
+            self.flush_task.add_done_callback(self.on_flush_done)
+
+    def on_flush_done(self, task: asyncio.Task) -> None:
+        self.flush_task = None
+        if not task.cancelled() and task.exception() is not None:
+            log.error(f"can not flush the database: {task.exception()}")
+
+    async def save_handler_context(self, context: Context) -> None:
+        self.set_handler_context(context)
+        await self.flush()
+
+    async def flush(self) -> None:
+        if (
+            len(self.dirty_contexts) == 0
+            and len(self.outbox_inserts) == 0
+            and len(self.outbox_deletes) == 0
+        ):
+            return
+        # the pending changes are taken at once, the next ones wait for
+        # the next flush; the writer thread keeps the flushes in order
+        outbox_inserts = list(self.outbox_inserts.values())
+        outbox_deletes = [(outbox_id,) for outbox_id in self.outbox_deletes]
+        contexts = [
+            (*row, telegram_id) for telegram_id, row in self.dirty_contexts.items()
+        ]
+        self.outbox_inserts = {}
+        self.outbox_deletes = []
+        self.dirty_contexts = {}
+        self.dirty_since = None
+
+        def write_changes(connection: Connection) -> float:
+            start = time.perf_counter()
+            # the letters must be in the outbox before their ack_seq is saved
+            if len(outbox_inserts) > 0:
+                connection.executemany(
+                    "INSERT OR REPLACE INTO outbox VALUES(?, ?, ?, ?, ?)",
+                    outbox_inserts,
+                )
+            if len(outbox_deletes) > 0:
+                connection.executemany("DELETE FROM outbox WHERE id=?", outbox_deletes)
+            if len(contexts) > 0:
+                connection.executemany(
+                    f"UPDATE clients SET {UPDATE_CONTEXT} WHERE telegram_id=?",
+                    contexts,
+                )
+            connection.commit()
+            return time.perf_counter() - start
+
+        duration = await self.write(write_changes)
+        metrics.db_flush_duration_metric.observe(duration)
+        log.debug(
+            f"flushed {len(contexts)} contexts, {len(outbox_inserts)} new and {len(outbox_deletes)} sent messages in {duration:.3f} seconds"
         )
-        self.connection.commit()
-        log.debug(f"samoware context for the client {telegram_id} has inserted")
-
-    def get_samoware_context(self, telegram_id: int) -> Context | None:
-        row = self.connection.execute(
-            "SELECT samoware_context FROM clients WHERE telegram_id=?",
-            (telegram_id,),
-        ).fetchone()
+
+    async def get_samoware_context(self, telegram_id: int) -> Context | None:
+        def select(connection: Connection) -> tuple | None:
+            return connection.execute(
+                f"SELECT {SELECT_CONTEXT} FROM clients WHERE telegram_id=?",
+                (telegram_id,),
+            ).fetchone()
+
+        row = await self.read(select)
         if row is None:
             log.warning(
                 f"trying to fetch context for {telegram_id}, but context does not exist"
             )
             return None
-        (context_encoded,) = row
-        raw_context = map_context_from_dict(loads(context_encoded), telegram_id)
+        raw_context = map_context_from_row(row, telegram_id)
         log.debug(f"requested samoware context for the client {telegram_id}")
         return raw_context
 
-    def get_password(self, telegram_id: int) -> str | None:
-        row = self.connection.execute(
-            "SELECT password FROM clients WHERE telegram_id=?", (telegram_id,)
-        ).fetchone()
+    async def get_password(self, telegram_id: int) -> str | None:
+        def select(connection: Connection) -> str | None:
+            row = connection.execute(
+                "SELECT password FROM clients WHERE telegram_id=?", (telegram_id,)
+            ).fetchone()
+            return (
+                self.encrypter.decrypt(row[0])
+                if row is not None and row[0] is not None
+                else None
+            )
+
+        password = await self.read(select)
         log.debug(f"requested password for the client {telegram_id}")
-        return (
-            self.encrypter.decrypt(row[0])
-            if row is not None and row[0] is not None
-            else None
-        )
+        return password
 
     def is_client_active(self, telegram_id: int) -> bool:
-        is_active = (
-            self.connection.execute(
-                "SELECT COUNT(*) FROM clients WHERE telegram_id = ?", (telegram_id,)
-            ).fetchone()[0]
-            != 0
-        )
-        log.debug(f"client {telegram_id} is active: {is_active}")
-        return is_active
+        return telegram_id in self.clients
 
-    def get_all_clients(self) -> list[tuple[int, Context]]:
-        def map_client_from_tuple(client):
-            (telegram_id, context) = client
-            return (
-                telegram_id,
-                map_context_from_dict(
-                    loads(context),
-                    telegram_id,
-                ),
-            )
-
-        clients = list(
-            map(
-                map_client_from_tuple,
-                self.connection.execute(
-                    "SELECT telegram_id, samoware_context FROM clients"
-                ).fetchall(),
-            )
+    async def get_all_clients(self) -> list[tuple[int, Context]]:
+        rows = await self.read(
+            lambda connection: connection.execute(
+                f"SELECT telegram_id, {SELECT_CONTEXT} FROM clients"
+            ).fetchall()
         )
+        clients = [(row[0], map_context_from_row(row[1:], row[0])) for row in rows]
         log.debug(
             f"fetching all clients from database, an amount of the clients {len(clients)}"
         )
         return clients
 
-    def get_all_clients_stat(self) -> list[tuple[int, Context, bool, bool]]:
-        def map_client_from_tuple(client):
-            (telegram_id, context, password, autoread) = client
-            return (
-                telegram_id,
-                map_context_from_dict(
-                    loads(context),
+    async def get_clients_stat(self) -> dict[tuple[bool, bool], int]:
+        """
+        Returns the amount of the clients by (has password, autoread).
+        """
+        rows = await self.read(
+            lambda connection: connection.execute(
+                "SELECT password IS NOT NULL, autoread, COUNT(*) FROM clients "
+                "GROUP BY password IS NOT NULL, autoread"
+            ).fetchall()
+        )
+        log.debug(f"fetching clients statistics: {rows}")
+        return {
+            (bool(has_password), bool(autoread)): amount
+            for has_password, autoread, amount in rows
+        }
+
+    async def remove_client(self, telegram_id: int) -> None:
+        self.dirty_contexts.pop(telegram_id, None)
+
+        def delete(connection: Connection) -> None:
+            connection.execute(
+                "DELETE FROM clients WHERE telegram_id=?", (telegram_id,)
+            )
+            connection.commit()
+
+        await self.write(delete)
+        log.debug(f"client {telegram_id} was removed")
+        if self.clients.pop(telegram_id, None) is not None:
+            for listener in self.removal_listeners:
+                listener(telegram_id)
+
+    async def set_autoread(self, telegram_id: int, enabled: bool) -> None:
+        def update(connection: Connection) -> None:
+            connection.execute(
+                "UPDATE clients SET autoread=? WHERE telegram_id=?",
+                (
+                    enabled,
                     telegram_id,
                 ),
-                password is not None,
-                bool(autoread),
             )
+            connection.commit()
+
+        await self.write(update)
+        if telegram_id in self.clients:
+            self.clients[telegram_id].autoread = enabled
+        log.debug(f"autoread for {telegram_id} was set to {enabled}")
+
+    def get_autoread(self, telegram_id: int) -> bool:
+        settings = self.clients.get(telegram_id)
+        return settings is not None and settings.autoread
+
+    def has_password(self, telegram_id: int) -> bool:
+        settings = self.clients.get(telegram_id)
+        return settings is not None and settings.has_password
+
+    async def get_telegram_file_id(self, digest: str) -> str | None:
+        def select(connection: Connection) -> str | None:
+            row = connection.execute(
+                "SELECT file_id FROM telegram_attachments WHERE digest=?", (digest,)
+            ).fetchone()
+            return row[0] if row is not None else None
+
+        return await self.read(select)
+
+    async def add_telegram_file_ids(self, file_ids: list[tuple[str, str]]) -> None:
+        def insert(connection: Connection) -> None:
+            connection.executemany(
+                "INSERT OR REPLACE INTO telegram_attachments VALUES(?, ?)", file_ids
+            )
+            connection.commit()
 
-        clients = list(
-            map(
-                map_client_from_tuple,
-                self.connection.execute(
-                    "SELECT telegram_id, samoware_context, password, autoread FROM clients"
-                ).fetchall(),
+        await self.write(insert)
+        log.debug(f"{len(file_ids)} telegram file ids were saved")
+
+    async def remove_telegram_file_ids(self, digests: list[str]) -> None:
+        def delete(connection: Connection) -> None:
+            connection.executemany(
+                "DELETE FROM telegram_attachments WHERE digest=?",
+                [(digest,) for digest in digests],
             )
-        )
-        log.debug(
-            f"fetching all clients from database for gathering statistics, an amount of the clients {len(clients)}"
-        )
-        return clients
+            connection.commit()
 
-    def remove_client(self, telegram_id: int) -> None:
-        self.connection.execute(
-            "DELETE FROM clients WHERE telegram_id=?", (telegram_id,)
+        await self.write(delete)
+        log.debug(f"{len(digests)} telegram file ids were removed")
+
+    def add_outbox_message(
+        self,
+        outbox_id: str,
+        telegram_id: int,
+        message: str,
+        format: str | None,
+        attachments: list[dict] | None,
+    ) -> None:
+        self.outbox_inserts[outbox_id] = (
+            outbox_id,
+            telegram_id,
+            message,
+            format,
+            dumps(attachments) if attachments is not None else None,
         )
-        self.connection.commit()
-        log.debug(f"client {telegram_id} was removed")
 
-    def set_autoread(self, telegram_id: int, enabled: bool) -> None:
-        self.connection.execute(
-            "UPDATE clients SET autoread=? WHERE telegram_id=?",
+    def remove_outbox_message(self, outbox_id: str) -> None:
+        if self.outbox_inserts.pop(outbox_id, None) is None:
+            self.outbox_deletes.append(outbox_id)
+
+    async def get_outbox_messages(
+        self,
+    ) -> list[tuple[str, int, str, str | None, list[dict] | None]]:
+        rows = await self.read(
+            lambda connection: connection.execute(
+                "SELECT id, telegram_id, message, format, attachments FROM outbox ORDER BY rowid"
+            ).fetchall()
+        )
+        messages = [
             (
-                enabled,
+                outbox_id,
                 telegram_id,
-            ),
-        )
-        self.connection.commit()
-        log.debug(f"autoread for {telegram_id} was set to {enabled}")
-
-    def get_autoread(self, telegram_id: int) -> bool:
-        enabled = self.connection.execute(
-            "SELECT autoread FROM clients WHERE telegram_id=?", (telegram_id,)
-        ).fetchone()[0]
-        log.debug(f"autoread for {telegram_id} is set to {enabled}")
-        return enabled
+                message,
+                format,
+                loads(attachments) if attachments is not None else None,
+            )
+            for (outbox_id, telegram_id, message, format, attachments) in rows
+        ]
+        log.debug(f"fetched {len(messages)} messages from the outbox")
+        return messages
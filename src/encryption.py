@@ -1,9 +1,8 @@
 import env
 import logging as log
-from Crypto.Cipher import AES
-from Crypto.Hash import SHA256
-import Crypto.Random as Random
 import base64
+import hashlib
+import os
 
 BLOCK_SIZE = 16
 
@@ -23,21 +22,26 @@ class Encrypter:
         self.encryption_key = env.get_encryption_key()
         if self.encryption_key is None:
             log.warning("encryption key does not specified: using generated key")
-            self.encryption_key = Random.get_random_bytes(32)
+            self.encryption_key = os.urandom(32)
             log.debug(f"working with generated encryption key: {self.encryption_key}")
         else:
-            self.encryption_key = SHA256.new(
+            self.encryption_key = hashlib.sha256(
                 self.encryption_key.encode("utf-8")
             ).digest()
         log.info("encrypter has initialized")
 
     def encrypt(self, data: str) -> bytes:
+        # Crypto is loaded with the first password, not on the startup
+        from Crypto.Cipher import AES
+
         raw = str.encode(pad(data), encoding="utf-8")
-        iv = Random.new().read(AES.block_size)
+        iv = os.urandom(AES.block_size)
         cipher = AES.new(self.encryption_key, AES.MODE_CBC, iv)
         return base64.b64encode(iv + cipher.encrypt(raw))
 
     def decrypt(self, data: bytes) -> str | None:
+        from Crypto.Cipher import AES
+
         enc = base64.b64decode(data)
         iv = enc[:16]
         cipher = AES.new(self.encryption_key, AES.MODE_CBC, iv)
@@ -1,6 +1,17 @@
 import os
 from dotenv import load_dotenv
 
+from const import (
+    ATTACHMENTS_IN_FLIGHT_LIMIT_MB,
+    DB_FLUSH_INTERVAL_SEC,
+    DB_MAX_STALENESS_SEC,
+    HTTP_POOL_LIMIT_PER_HOST,
+    MAIL_CACHE_MEMORY_LIMIT_MB,
+    MAIL_RENDER_WORKERS,
+    STARTUP_RAMP_CONCURRENCY,
+    STARTUP_RAMP_RATE,
+)
+
 load_dotenv(".env")
 
 PROFILE_VAR_NAME = "ENV"
@@ -11,6 +22,16 @@ ENCRYPTION_KEY_VAR_NAME = "ENCRYPTION"
 IP_CHECK_VAR_NAME = "IP_CHECK"
 ENABLE_PROMETHEUS_METRICS_SERVER_VAR_NAME = "ENABLE_PROMETHEUS_METRICS_SERVER"
 PROMETHEUS_METRICS_SERVER_PORT_VAR_NAME = "PROMETHEUS_METRICS_SERVER_PORT"
+HTTP_POOL_LIMIT_PER_HOST_VAR_NAME = "HTTP_POOL_LIMIT_PER_HOST"
+MAIL_HTML_PARSER_VAR_NAME = "MAIL_HTML_PARSER"
+MAIL_RENDER_EXECUTOR_VAR_NAME = "MAIL_RENDER_EXECUTOR"
+MAIL_RENDER_WORKERS_VAR_NAME = "MAIL_RENDER_WORKERS"
+ATTACHMENTS_IN_FLIGHT_LIMIT_MB_VAR_NAME = "ATTACHMENTS_IN_FLIGHT_LIMIT_MB"
+MAIL_CACHE_MEMORY_LIMIT_MB_VAR_NAME = "MAIL_CACHE_MEMORY_LIMIT_MB"
+DB_FLUSH_INTERVAL_SEC_VAR_NAME = "DB_FLUSH_INTERVAL_SEC"
+DB_MAX_STALENESS_SEC_VAR_NAME = "DB_MAX_STALENESS_SEC"
+STARTUP_RAMP_RATE_VAR_NAME = "STARTUP_RAMP_RATE"
+STARTUP_RAMP_CONCURRENCY_VAR_NAME = "STARTUP_RAMP_CONCURRENCY"
 
 DEV_PROFILE_NAME = "DEV"
 PROD_PROFILE_NAME = "PROD"
@@ -38,6 +59,71 @@ def get_prometheus_metrics_server_port() -> int:
     return os.environ.get(PROMETHEUS_METRICS_SERVER_PORT_VAR_NAME, default=53000)
 
 
+def get_http_pool_limit_per_host() -> int:
+    return int(
+        os.environ.get(
+            HTTP_POOL_LIMIT_PER_HOST_VAR_NAME, default=HTTP_POOL_LIMIT_PER_HOST
+        )
+    )
+
+
+def get_mail_html_parser() -> str:
+    return os.environ.get(MAIL_HTML_PARSER_VAR_NAME, default="html.parser")
+
+
+def get_mail_render_executor() -> str:
+    return os.environ.get(MAIL_RENDER_EXECUTOR_VAR_NAME, default="process")
+
+
+def get_mail_render_workers() -> int:
+    return int(
+        os.environ.get(MAIL_RENDER_WORKERS_VAR_NAME, default=MAIL_RENDER_WORKERS)
+    )
+
+
+def get_attachments_in_flight_limit() -> int:
+    limit_mb = int(
+        os.environ.get(
+            ATTACHMENTS_IN_FLIGHT_LIMIT_MB_VAR_NAME,
+            default=ATTACHMENTS_IN_FLIGHT_LIMIT_MB,
+        )
+    )
+    return limit_mb * 1024 * 1024
+
+
+def get_mail_cache_memory_limit() -> int:
+    limit_mb = int(
+        os.environ.get(
+            MAIL_CACHE_MEMORY_LIMIT_MB_VAR_NAME, default=MAIL_CACHE_MEMORY_LIMIT_MB
+        )
+    )
+    return limit_mb * 1024 * 1024
+
+
+def get_db_flush_interval() -> float:
+    return float(
+        os.environ.get(DB_FLUSH_INTERVAL_SEC_VAR_NAME, default=DB_FLUSH_INTERVAL_SEC)
+    )
+
+
+def get_db_max_staleness() -> float:
+    return float(
+        os.environ.get(DB_MAX_STALENESS_SEC_VAR_NAME, default=DB_MAX_STALENESS_SEC)
+    )
+
+
+def get_startup_ramp_rate() -> float:
+    return float(os.environ.get(STARTUP_RAMP_RATE_VAR_NAME, default=STARTUP_RAMP_RATE))
+
+
+def get_startup_ramp_concurrency() -> int:
+    return int(
+        os.environ.get(
+            STARTUP_RAMP_CONCURRENCY_VAR_NAME, default=STARTUP_RAMP_CONCURRENCY
+        )
+    )
+
+
 def is_ip_check_enabled() -> bool:
     return os.environ.get(IP_CHECK_VAR_NAME) is not None
 
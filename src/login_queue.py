@@ -0,0 +1,78 @@
+import asyncio
+from collections import deque
+from contextlib import contextmanager
+import logging as log
+import time
+from typing import Awaitable, Callable, Iterator, TypeVar
+
+import metrics
+
+T = TypeVar("T")
+
+
+class LoginQueue:
+    """
+    Admission of the /login commands: at most `concurrency` logins
+    talk to Samoware at once, the rest wait in a FIFO queue and learn
+    their position. The wait together with the Samoware login is
+    bounded by a timeout, the saving of the client is not, so a timed
+    out login never leaves a half added client. A user has at most
+    one /login command in flight.
+    """
+
+    def __init__(self, concurrency: int, timeout_sec: float) -> None:
+        self.slots = asyncio.Semaphore(concurrency)
+        self.timeout_sec = timeout_sec
+        self.users: set[int] = set()
+        self.waiting: deque[object] = deque()
+
+    def is_queued(self, telegram_id: int) -> bool:
+        return telegram_id in self.users
+
+    @contextmanager
+    def hold(self, telegram_id: int) -> Iterator[None]:
+        self.users.add(telegram_id)
+        try:
+            yield
+        finally:
+            self.users.discard(telegram_id)
+
+    async def run(
+        self,
+        login: Callable[[], Awaitable[T]],
+        on_queued: Callable[[int], Awaitable[None]],
+    ) -> T:
+        """
+        Runs the login when a slot is free, raises TimeoutError
+        if it does not finish in time.
+        """
+        # the waiters are only kept to tell the queue position
+        waiter = object()
+        self.waiting.append(waiter)
+        metrics.login_queue_size_metric.set(len(self.waiting))
+        is_admitted = False
+        try:
+            async with asyncio.timeout(self.timeout_sec):
+                if self.slots.locked():
+                    await on_queued(len(self.waiting))
+                start = time.perf_counter()
+                await self.slots.acquire()
+                is_admitted = True
+                metrics.login_queue_wait_metric.observe(time.perf_counter() - start)
+                self.waiting.remove(waiter)
+                metrics.login_queue_size_metric.set(len(self.waiting))
+                start = time.perf_counter()
+                try:
+                    return await login()
+                finally:
+                    metrics.login_duration_metric.observe(time.perf_counter() - start)
+        except TimeoutError:
+            log.warning("login has timed out")
+            metrics.login_timeout_metric.inc()
+            raise
+        finally:
+            if is_admitted:
+                self.slots.release()
+            else:
+                self.waiting.remove(waiter)
+                metrics.login_queue_size_metric.set(len(self.waiting))
@@ -0,0 +1,125 @@
+import asyncio
+from collections import OrderedDict
+import logging as log
+import time
+from typing import Awaitable, Callable
+
+from const import MAIL_CACHE_SIZE, MAIL_CACHE_TTL_SEC
+import env
+import metrics
+from samoware_api import MailBody, MailHeader, fetch_attachments
+
+MailCacheKey = tuple[str, int, float]
+
+
+class MailCacheEntry:
+    def __init__(self, body: MailBody) -> None:
+        self.body = body
+        self.created_at = time.monotonic()
+
+
+class MailCache:
+    """
+    Rendered mails shared between users.
+    University mailings come to many mailboxes at once, so the first
+    user loads and renders the mail and the rest reuse its text and
+    attachments. Concurrent loads of the same mail are merged into one.
+    Cached attachments are downloaded up front: their links only work
+    within the session of the first user.
+    """
+
+    def __init__(self, max_entries: int, ttl_sec: float, memory_limit: int) -> None:
+        self.max_entries = max_entries
+        self.ttl_sec = ttl_sec
+        self.memory_limit = memory_limit
+        self.entries: OrderedDict[MailCacheKey, MailCacheEntry] = OrderedDict()
+        self.loading: dict[MailCacheKey, asyncio.Future[None]] = {}
+
+    async def get_or_load(
+        self, header: MailHeader, load: Callable[[], Awaitable[MailBody]]
+    ) -> MailBody:
+        key = make_key(header)
+        if key is None:
+            return await load()
+
+        body = self.get(key)
+        if body is not None:
+            metrics.mail_cache_hit_metric.inc()
+            return body.acquire()
+
+        if key in self.loading:
+            await asyncio.shield(self.loading[key])
+            body = self.get(key)
+            if body is not None:
+                metrics.mail_cache_hit_metric.inc()
+                return body.acquire()
+            # the load has failed for the mailbox of another user
+            return await load()
+
+        metrics.mail_cache_miss_metric.inc()
+        future = asyncio.get_running_loop().create_future()
+        self.loading[key] = future
+        try:
+            body = await load()
+            # the attachment links are bound to the session of the loader,
+            # so the shared copy is downloaded while the session is alive
+            try:
+                await fetch_attachments(body.attachments)
+            except Exception:
+                log.exception(f"can not fetch the attachments of {key[0]} to cache")
+                return body
+            result = body.acquire()
+            self.put(key, body)
+        finally:
+            del self.loading[key]
+            future.set_result(None)
+        return result
+
+    def get(self, key: MailCacheKey) -> MailBody | None:
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if time.monotonic() - entry.created_at > self.ttl_sec:
+            self.evict(key)
+            return None
+        self.entries.move_to_end(key)
+        return entry.body
+
+    def put(self, key: MailCacheKey, body: MailBody) -> None:
+        self.entries[key] = MailCacheEntry(body)
+        self.shrink()
+
+    def shrink(self) -> None:
+        # attachments are loaded lazily, so the size is evaluated on every put
+        memory_size = sum(entry.body.get_size() for entry in self.entries.values())
+        # the newest entry is kept even if it is larger than the limit
+        while len(self.entries) > 1 and (
+            len(self.entries) > self.max_entries or memory_size > self.memory_limit
+        ):
+            key = next(iter(self.entries))
+            memory_size -= self.entries[key].body.get_size()
+            self.evict(key)
+        metrics.mail_cache_size_metric.set(len(self.entries))
+        metrics.mail_cache_memory_metric.set(memory_size)
+
+    def evict(self, key: MailCacheKey) -> None:
+        entry = self.entries.pop(key)
+        entry.body.close()
+        log.debug(f"mail {key[0]} is evicted from the cache")
+
+    def clear(self) -> None:
+        for key in list(self.entries):
+            self.evict(key)
+        metrics.mail_cache_size_metric.set(0)
+        metrics.mail_cache_memory_metric.set(0)
+
+
+def make_key(header: MailHeader) -> MailCacheKey | None:
+    if header.message_id is None:
+        return None
+    return (header.message_id, header.size, header.utc_time.timestamp())
+
+
+mail_cache = MailCache(
+    MAIL_CACHE_SIZE, MAIL_CACHE_TTL_SEC, env.get_mail_cache_memory_limit()
+)
@@ -0,0 +1,204 @@
+import asyncio
+from concurrent.futures import Executor, ProcessPoolExecutor, ThreadPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+import html
+import logging as log
+import multiprocessing
+import re
+import time
+from typing import TYPE_CHECKING
+
+from const import MAIL_RENDER_QUEUE_SIZE_PER_WORKER
+import env
+import metrics
+
+if TYPE_CHECKING:
+    import bs4 as bs
+
+AGGRESSIVE_FORMAT_LETTER = True
+
+MAIL_BODY_CLASS = "samoware-RFC822-body"
+ATTACHMENT_TAG = "cg-message-attachment"
+
+SPACES_PATTERN = re.compile(" +")
+CARRIAGE_RETURNS_PATTERN = re.compile("\r+")
+NEW_LINES_PATTERN = re.compile("\n+")
+PARAGRAPH_BREAKS_PATTERN = re.compile("\n{2,}")
+
+PROCESS_EXECUTOR = "process"
+THREAD_EXECUTOR = "thread"
+
+_executor: Executor | None = None
+_queue_slots: asyncio.Semaphore | None = None
+_queue_depth = 0
+
+
+class RenderedMail:
+    def __init__(self, text: str, attachments: list[tuple[str, str]]) -> None:
+        self.text = text
+        # (attachment ref, attachment name)
+        self.attachments = attachments
+
+
+def start_executor() -> Executor:
+    global _executor, _queue_slots
+    workers = env.get_mail_render_workers()
+    if env.get_mail_render_executor() == PROCESS_EXECUTOR:
+        try:
+            _executor = ProcessPoolExecutor(
+                max_workers=workers,
+                mp_context=multiprocessing.get_context("forkserver"),
+            )
+        except (OSError, ValueError, NotImplementedError):
+            log.exception("can not start a process pool, using a thread pool")
+    if _executor is None:
+        _executor = ThreadPoolExecutor(
+            max_workers=workers, thread_name_prefix="mail_renderer"
+        )
+    _queue_slots = asyncio.Semaphore(workers * MAIL_RENDER_QUEUE_SIZE_PER_WORKER)
+    log.info(f"mail renderer executor has started: {type(_executor).__name__}")
+    return _executor
+
+
+def shutdown_executor() -> None:
+    global _executor, _queue_slots
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        log.info("mail renderer executor is shut down")
+    _executor = None
+    _queue_slots = None
+
+
+async def render_mail_async(page: str) -> RenderedMail:
+    """
+    Renders the mail in the executor, so the event loop only does io.
+    The amount of the submitted pages is bounded, the rest wait here.
+    """
+    global _queue_depth
+    if _executor is None:
+        start_executor()
+    _queue_depth += 1
+    try:
+        metrics.mail_render_queue_depth_metric.observe(_queue_depth)
+        async with _queue_slots:
+            rendered_mail, duration = await asyncio.get_running_loop().run_in_executor(
+                _executor, render_mail_timed, page
+            )
+    except BrokenProcessPool:
+        log.exception("mail renderer process pool is broken, restarting it")
+        shutdown_executor()
+        raise
+    finally:
+        _queue_depth -= 1
+    metrics.mail_render_duration_metric.observe(duration)
+    return rendered_mail
+
+
+def render_mail_timed(page: str) -> tuple[RenderedMail, float]:
+    start = time.perf_counter()
+    rendered_mail = render_mail(page)
+    return rendered_mail, time.perf_counter() - start
+
+
+def get_parser() -> str:
+    parser = env.get_mail_html_parser()
+    if parser == "lxml":
+        try:
+            import lxml  # noqa: F401
+        except ImportError:
+            log.warning("lxml is not installed, html.parser is used instead")
+            return "html.parser"
+    return parser
+
+
+def render_mail(page: str) -> RenderedMail:
+    # bs4 takes a noticeable part of the startup, it waits for the first mail
+    import bs4 as bs
+
+    # the whole page is parsed: a strainer nests the mail parts
+    # differently around stray closing tags
+    tree = bs.BeautifulSoup(page, get_parser())
+
+    out: list[str] = []
+    for mail_body_html in tree.find_all("div", {"class": MAIL_BODY_CLASS}):
+        if log.getLogger().isEnabledFor(log.DEBUG):
+            log.debug("mail body: " + str(mail_body_html.encode()))
+        found_text_beg = False
+        for element in mail_body_html.children:
+            if isinstance(element, bs.Tag) and element.has_attr("class"):
+                classes = element["class"]
+                if "textBeg" in classes:
+                    found_text_beg = True
+                    log.debug("found textBeg")
+                if "textEnd" in classes:
+                    log.debug("found textEnd")
+                    break
+            if found_text_beg:
+                render_element(element, out)
+
+    attachments = [
+        (attachment_html["attachment-ref"], attachment_html["attachment-name"])
+        for attachment_html in tree.find_all(ATTACHMENT_TAG)
+    ]
+    return RenderedMail(format_text("".join(out)), attachments)
+
+
+def format_text(text: str) -> str:
+    text = CARRIAGE_RETURNS_PATTERN.sub("\r", text).strip()
+    text = NEW_LINES_PATTERN.sub("\n", text).strip()
+    text = text.replace("\r", "\n\n")
+    if AGGRESSIVE_FORMAT_LETTER:
+        text = text.replace("\n\xa0\n", "\n\n")
+    return PARAGRAPH_BREAKS_PATTERN.sub("\n\n", text).strip()
+
+
+def render_string(string: "bs.NavigableString") -> str:
+    return html.escape(
+        SPACES_PATTERN.sub(" ", string.replace("\r", "").strip("\n").replace("\n", " "))
+    )
+
+
+def render_element(element: "bs.PageElement", out: list[str]) -> None:
+    """
+    Appends the telegram html of the element to out.
+    The tree is walked with an explicit stack: plain str items are
+    closing markup, int items mark the start of a blockquote in out.
+    """
+    import bs4 as bs
+
+    stack: list = [element]
+    while len(stack) > 0:
+        node = stack.pop()
+        node_type = type(node)
+        if node_type is str:
+            out.append(node)
+        elif node_type is int:
+            quote = "".join(out[node:]).strip()
+            del out[node:]
+            out.append("<blockquote>" + quote + "</blockquote>")
+        elif isinstance(node, bs.NavigableString):
+            out.append(render_string(node))
+        elif isinstance(node, bs.Tag):
+            name = node.name
+            if name == "a" and "href" in node.attrs:
+                out.append(f'<a href="{node["href"]}">')
+                stack.append("</a>")
+            elif name == "style":
+                continue
+            elif name == "br":
+                out.append("\n")
+                continue
+            elif name == "hr":
+                out.append("\n----------\n")
+                continue
+            elif name == "p":
+                out.append("\r")
+                stack.append("\r")
+            elif name == "div":
+                out.append("\n")
+                stack.append("\n")
+            elif name == "li":
+                stack.append("\n")
+            elif name == "blockquote":
+                stack.append(len(out))
+            stack.extend(reversed(node.contents))
@@ -1,4 +1,4 @@
-from prometheus_client import Gauge, Counter
+from prometheus_client import Gauge, Counter, Histogram
 
 GATHER_METRIC_DELAY_SEC = 3 * 60  # 3 min
 
@@ -14,11 +14,61 @@ incoming_commands_metric = Counter(
     "incoming_command", "Incoming commands metric", labelnames=["command_name"]
 )
 sent_message_metric = Counter("sent_message", "Sent messages metric")
+delivery_queue_depth_metric = Gauge(
+    "delivery_queue_depth", "Queued outbound telegram messages metric"
+)
+delivery_wait_metric = Histogram(
+    "delivery_wait_sec",
+    "Time from enqueueing to sending an outbound telegram message metric",
+    buckets=(0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300),
+)
+sent_attachment_metric = Counter(
+    "sent_attachment", "Sent attachments metric", labelnames=["uploaded"]
+)
 
 # Samoware
 samoware_response_status_code_metric = Counter(
     "samoware_response_sc", "Samoware reponses status code metric", labelnames=["sc"]
 )
+samoware_pool_connections_metric = Gauge(
+    "samoware_pool_connections",
+    "Samoware http pool connections metric",
+    labelnames=["state"],
+)
+samoware_pool_connection_metric = Counter(
+    "samoware_pool_connection",
+    "Samoware http pool connection acquisitions metric",
+    labelnames=["reused"],
+)
+samoware_pool_reuse_ratio_metric = Gauge(
+    "samoware_pool_reuse_ratio", "Samoware http pool connection reuse ratio metric"
+)
+samoware_outage_metric = Gauge(
+    "samoware_outage", "Whether the polling is paused by a Samoware outage"
+)
+samoware_parked_pollers_metric = Gauge(
+    "samoware_parked_pollers", "Pollers waiting for Samoware to recover metric"
+)
+samoware_health_probe_metric = Counter(
+    "samoware_health_probe",
+    "Samoware availability probes metric",
+    labelnames=["is_successful"],
+)
+attachments_in_flight_bytes_metric = Gauge(
+    "attachments_in_flight_bytes", "Downloaded but not sent attachment bytes metric"
+)
+mail_cache_hit_metric = Counter("mail_cache_hit", "Mail cache hits metric")
+mail_cache_miss_metric = Counter("mail_cache_miss", "Mail cache misses metric")
+mail_cache_size_metric = Gauge("mail_cache_size", "Mail cache entries metric")
+mail_cache_memory_metric = Gauge(
+    "mail_cache_memory_bytes", "Mail cache texts and attachments bytes metric"
+)
+
+db_flush_duration_metric = Histogram(
+    "db_flush_duration_sec",
+    "Batched database flush time metric",
+    buckets=(0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1),
+)
 
 # Domain
 login_metric = Counter("login", "Login events metric", labelnames=["is_successful"])
@@ -34,3 +84,64 @@ client_handler_error_metric = Counter(
     "client_handler_error", "Client handler error events metric", labelnames=["type"]
 )
 incoming_letter_metric = Counter("incoming_letter", "Incoming letter events metric")
+login_queue_size_metric = Gauge("login_queue_size", "Logins waiting for a slot metric")
+login_queue_wait_metric = Histogram(
+    "login_queue_wait_sec",
+    "Login wait for a slot metric",
+    buckets=(0.1, 0.5, 1, 5, 10, 30, 60, 120),
+)
+login_duration_metric = Histogram(
+    "login_duration_sec",
+    "Login time after the admission metric",
+    buckets=(0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120),
+)
+login_timeout_metric = Counter("login_timeout", "Timed out logins metric")
+login_stage_duration_metric = Histogram(
+    "login_stage_duration_sec",
+    "Login and revalidation stages time metric",
+    labelnames=["stage"],
+    buckets=(0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
+revalidation_backlog_metric = Gauge(
+    "revalidation_backlog", "Sessions due for a revalidation metric"
+)
+revalidation_scheduled_metric = Gauge(
+    "revalidation_scheduled", "Sessions with a planned revalidation metric"
+)
+retry_metric = Counter(
+    "retry", "Retries metric", labelnames=["operation", "error_class"]
+)
+retry_given_up_metric = Counter(
+    "retry_given_up", "Operations given up after retries", labelnames=["operation"]
+)
+retry_budget_exhausted_metric = Counter(
+    "retry_budget_exhausted",
+    "Retries delayed by an exhausted client retry budget",
+    labelnames=["operation"],
+)
+startup_ramp_progress_metric = Gauge(
+    "startup_ramp_progress", "Share of the saved clients resumed after a restart"
+)
+startup_session_state_metric = Counter(
+    "startup_session_state",
+    "States of the sessions restored after a restart",
+    labelnames=["state"],
+)
+startup_relogin_queue_metric = Gauge(
+    "startup_relogin_queue", "Restored sessions waiting for a relogin metric"
+)
+startup_online_duration_metric = Gauge(
+    "startup_online_duration_sec", "Time to resume all the saved clients metric"
+)
+
+# Mail rendering
+mail_render_queue_depth_metric = Histogram(
+    "mail_render_queue_depth",
+    "Mail renderer executor queue depth metric",
+    buckets=(0, 1, 2, 4, 8, 16, 32, 64, 128, 256),
+)
+mail_render_duration_metric = Histogram(
+    "mail_render_duration_sec",
+    "Mail rendering time metric",
+    buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10),
+)
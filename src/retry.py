@@ -0,0 +1,142 @@
+from collections import deque
+import random
+import time
+from urllib.error import HTTPError
+import xml.etree.ElementTree as ET
+
+import aiohttp
+import telegram.error
+
+from const import (
+    HTTP_RETRY_DELAY_SEC,
+    RETRY_BUDGET_SIZE,
+    RETRY_BUDGET_WINDOW_SEC,
+    RETRY_CONNECTION_DELAY_SEC,
+    RETRY_MAX_DELAY_SEC,
+    RETRY_TIMEOUT_DELAY_SEC,
+    TELEGRAM_SEND_RETRY_DELAY_SEC,
+)
+import metrics
+
+TIMEOUT_ERROR = "timeout"
+CONNECTION_ERROR = "connection"
+SERVER_ERROR = "server"
+PARSE_ERROR = "parse"
+OTHER_ERROR = "other"
+
+
+def classify_error(error: BaseException) -> str:
+    # telegram timeouts are network errors too, so they are checked first
+    if isinstance(error, (TimeoutError, telegram.error.TimedOut)):
+        return TIMEOUT_ERROR
+    if isinstance(error, (aiohttp.ClientConnectionError, telegram.error.NetworkError)):
+        return CONNECTION_ERROR
+    if isinstance(error, HTTPError) and error.code >= 500:
+        return SERVER_ERROR
+    if isinstance(error, ET.ParseError):
+        return PARSE_ERROR
+    return OTHER_ERROR
+
+
+class RetryPolicy:
+    """
+    Exponential backoff with decorrelated jitter: every delay is
+    random between the base delay and three previous delays.
+    """
+
+    def __init__(self, base_sec: float, cap_sec: float) -> None:
+        self.base_sec = base_sec
+        self.cap_sec = cap_sec
+
+    def next_delay(self, previous_delay: float) -> float:
+        return min(
+            self.cap_sec,
+            random.uniform(self.base_sec, max(self.base_sec, previous_delay * 3)),
+        )
+
+
+SAMOWARE_RETRY_POLICIES = {
+    TIMEOUT_ERROR: RetryPolicy(RETRY_TIMEOUT_DELAY_SEC, RETRY_MAX_DELAY_SEC),
+    CONNECTION_ERROR: RetryPolicy(RETRY_CONNECTION_DELAY_SEC, RETRY_MAX_DELAY_SEC),
+    SERVER_ERROR: RetryPolicy(HTTP_RETRY_DELAY_SEC, RETRY_MAX_DELAY_SEC),
+    PARSE_ERROR: RetryPolicy(HTTP_RETRY_DELAY_SEC, RETRY_MAX_DELAY_SEC),
+    OTHER_ERROR: RetryPolicy(HTTP_RETRY_DELAY_SEC, RETRY_MAX_DELAY_SEC),
+}
+TELEGRAM_RETRY_POLICIES = {
+    TIMEOUT_ERROR: RetryPolicy(RETRY_TIMEOUT_DELAY_SEC, RETRY_MAX_DELAY_SEC),
+    CONNECTION_ERROR: RetryPolicy(RETRY_CONNECTION_DELAY_SEC, RETRY_MAX_DELAY_SEC),
+    SERVER_ERROR: RetryPolicy(TELEGRAM_SEND_RETRY_DELAY_SEC, RETRY_MAX_DELAY_SEC),
+    PARSE_ERROR: RetryPolicy(TELEGRAM_SEND_RETRY_DELAY_SEC, RETRY_MAX_DELAY_SEC),
+    OTHER_ERROR: RetryPolicy(TELEGRAM_SEND_RETRY_DELAY_SEC, RETRY_MAX_DELAY_SEC),
+}
+
+
+class RetryBudget:
+    """
+    Retries of one client within a time window.
+    When the budget is spent, the next retry waits for the oldest one
+    to leave the window, so a broken client can not flood the servers.
+    """
+
+    def __init__(self, size: int, window_sec: float) -> None:
+        self.size = size
+        self.window_sec = window_sec
+        self.retries: deque[float] = deque()
+
+    def reserve(self, operation: str) -> float:
+        """
+        Books a retry, returns the delay until it is allowed.
+        """
+        now = time.monotonic()
+        while len(self.retries) > 0 and self.retries[0] <= now - self.window_sec:
+            self.retries.popleft()
+        delay = 0.0
+        if len(self.retries) >= self.size:
+            delay = max(0.0, self.retries[-self.size] + self.window_sec - now)
+            metrics.retry_budget_exhausted_metric.labels(operation=operation).inc()
+        self.retries.append(now + delay)
+        return delay
+
+
+def make_retry_budget() -> RetryBudget:
+    return RetryBudget(RETRY_BUDGET_SIZE, RETRY_BUDGET_WINDOW_SEC)
+
+
+class Retry:
+    """
+    Retries of one operation: the delays grow while it fails
+    and start over after reset.
+    """
+
+    def __init__(
+        self,
+        operation: str,
+        policies: dict[str, RetryPolicy],
+        budget: RetryBudget,
+        max_attempts: int | None = None,
+    ) -> None:
+        self.operation = operation
+        self.policies = policies
+        self.budget = budget
+        self.max_attempts = max_attempts
+        self.attempts = 0
+        self.delay = 0.0
+
+    def next_delay(self, error: BaseException) -> float | None:
+        """
+        Returns the delay before the next attempt or None to give up.
+        """
+        error_class = classify_error(error)
+        self.attempts += 1
+        if self.max_attempts is not None and self.attempts >= self.max_attempts:
+            metrics.retry_given_up_metric.labels(operation=self.operation).inc()
+            return None
+        metrics.retry_metric.labels(
+            operation=self.operation, error_class=error_class
+        ).inc()
+        self.delay = self.policies[error_class].next_delay(self.delay)
+        return max(self.delay, self.budget.reserve(self.operation))
+
+    def reset(self) -> None:
+        self.attempts = 0
+        self.delay = 0.0
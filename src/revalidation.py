@@ -0,0 +1,122 @@
+import asyncio
+import heapq
+import logging as log
+import random
+import time
+from typing import TYPE_CHECKING
+
+from const import (
+    REVALIDATE_CONCURRENCY,
+    REVALIDATE_INTERVAL_SEC,
+    REVALIDATE_JITTER_SEC,
+    REVALIDATE_OVERDUE_SPREAD_SEC,
+)
+import metrics
+
+if TYPE_CHECKING:
+    from client_handler import ClientHandler
+
+
+class RevalidationScheduler:
+    """
+    Keeps the due times of the session revalidations in a heap.
+    A due handler is only flagged, it revalidates between its own polls,
+    so a revalidation never races the longpoll of the same session.
+    The due times are jittered and the overdue sessions are spread,
+    so the sessions restored together do not revalidate in bursts.
+    """
+
+    def __init__(
+        self,
+        interval_sec: float,
+        jitter_sec: float,
+        overdue_spread_sec: float,
+        concurrency: int,
+    ) -> None:
+        self.interval_sec = interval_sec
+        self.jitter_sec = jitter_sec
+        self.overdue_spread_sec = overdue_spread_sec
+        self.slots = asyncio.Semaphore(concurrency)
+        # (due timestamp, telegram id), outdated items are skipped on pop
+        self.heap: list[tuple[float, int]] = []
+        self.scheduled: dict[int, tuple[float, "ClientHandler"]] = {}
+        self.due: set[int] = set()
+        self.changed = asyncio.Event()
+        self.task: asyncio.Task | None = None
+
+    def start(self) -> None:
+        self.task = asyncio.create_task(self.run())
+
+    async def stop(self) -> None:
+        if self.task is not None:
+            self.task.cancel()
+            await asyncio.gather(self.task, return_exceptions=True)
+
+    def schedule(self, handler: "ClientHandler") -> None:
+        """
+        Plans the next revalidation after the last one of the handler.
+        """
+        telegram_id = handler.context.telegram_id
+        now = time.time()
+        due_at = (
+            handler.context.last_revalidate.timestamp()
+            + self.interval_sec
+            - random.uniform(0, self.jitter_sec)
+        )
+        if due_at < now:
+            due_at = now + random.uniform(0, self.overdue_spread_sec)
+        handler.revalidation_due = False
+        self.due.discard(telegram_id)
+        self.scheduled[telegram_id] = (due_at, handler)
+        heapq.heappush(self.heap, (due_at, telegram_id))
+        self.update_metrics()
+        if self.heap[0][1] == telegram_id:
+            self.changed.set()
+
+    def remove(self, handler: "ClientHandler") -> None:
+        telegram_id = handler.context.telegram_id
+        scheduled = self.scheduled.get(telegram_id)
+        if scheduled is not None and scheduled[1] is handler:
+            del self.scheduled[telegram_id]
+        # a due handler is not in scheduled anymore
+        self.due.discard(telegram_id)
+        self.update_metrics()
+
+    async def run(self) -> None:
+        while True:
+            self.changed.clear()
+            self.flag_due()
+            delay = self.heap[0][0] - time.time() if len(self.heap) > 0 else None
+            try:
+                await asyncio.wait_for(self.changed.wait(), delay)
+            except TimeoutError:
+                pass
+
+    def flag_due(self) -> None:
+        now = time.time()
+        while len(self.heap) > 0 and self.heap[0][0] <= now:
+            due_at, telegram_id = heapq.heappop(self.heap)
+            scheduled = self.scheduled.get(telegram_id)
+            if scheduled is None or scheduled[0] != due_at:
+                continue
+            del self.scheduled[telegram_id]
+            scheduled[1].revalidation_due = True
+            self.due.add(telegram_id)
+        self.update_metrics()
+
+    def update_metrics(self) -> None:
+        metrics.revalidation_backlog_metric.set(len(self.due))
+        metrics.revalidation_scheduled_metric.set(len(self.scheduled))
+
+    async def revalidate(self, handler: "ClientHandler") -> bool:
+        async with self.slots:
+            log.debug(f"revalidating the session of {handler.context.samoware_login}")
+            return await handler.revalidate()
+
+
+revalidation_scheduler = RevalidationScheduler(
+    REVALIDATE_INTERVAL_SEC,
+    REVALIDATE_JITTER_SEC,
+    REVALIDATE_OVERDUE_SPREAD_SEC,
+    REVALIDATE_CONCURRENCY,
+)
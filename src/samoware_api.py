@@ -1,69 +1,101 @@
-# TODO: причесать вызовы aiohttp
+import asyncio
+from collections import deque
+import hashlib
 import html
 from datetime import datetime
-from http.client import HTTPResponse
 from http.cookies import SimpleCookie
-from typing import Self
+from typing import AsyncIterator, Awaitable, TypeVar
 
+import random
 import re
 import logging as log
-import bs4 as bs
+import time
 import xml.etree.ElementTree as ET
-from aiohttp import ClientSession, ClientTimeout
+import ssl
+from tempfile import SpooledTemporaryFile
+from aiohttp import (
+    ClientError,
+    ClientResponse,
+    ClientSession,
+    ClientTimeout,
+    CookieJar,
+    DummyCookieJar,
+    TCPConnector,
+    TraceConfig,
+)
 from urllib.error import HTTPError
+from yarl import URL
 
 import env
 from const import (
+    ATTACHMENT_CHUNK_SIZE,
+    ATTACHMENT_DOWNLOADS_LIMIT,
+    ATTACHMENT_SPOOL_MEMORY_SIZE,
     HTTP_COMMON_TIMEOUT_SEC,
     HTTP_CONNECT_LONGPOLL_TIMEOUT_SEC,
     HTTP_FILE_LOAD_TIMEOUT_SEC,
+    HTTP_POOL_DNS_CACHE_TTL_SEC,
+    HTTP_POOL_KEEPALIVE_TIMEOUT_SEC,
+    HTTP_POOL_LIMIT,
     HTTP_TOTAL_LONGPOLL_TIMEOUT_SEC,
+    SAMOWARE_HEALTH_FAILURE_RATIO,
+    SAMOWARE_HEALTH_MIN_FAILURES,
+    SAMOWARE_HEALTH_PROBE_DELAY_SEC,
+    SAMOWARE_HEALTH_PROBE_MAX_DELAY_SEC,
+    SAMOWARE_HEALTH_RELEASE_SPREAD_SEC,
+    SAMOWARE_HEALTH_WINDOW_SEC,
 )
+import mail_renderer
 import metrics
+import ximss
+
+T = TypeVar("T")
 
 SESSION_TOKEN_PATTERN = re.compile("^[0-9]{6}-[a-zA-Z0-9]{20}$")
+XIMSS_TIME_PATTERN = re.compile("^[0-9]{8}T[0-9]{6}Z?$")
+# the commands which are sent again when their sync request is not accepted
+REQUEUED_COMMANDS = {"messageMark"}
+
+INBOX_FOLDER = "INBOX-MM-1"
+INBOX_FIELDS = (
+    "FLAGS",
+    "E-From",
+    "Subject",
+    "Pty",
+    "Content-Type",
+    "INTERNALDATE",
+    "SIZE",
+    "E-To",
+    "E-Cc",
+    "E-Reply-To",
+    "X-Color",
+    "Disposition-Notification-To",
+    "X-Request-DSN",
+    "References",
+    "Message-ID",
+)
 
-AGGRESSIVE_FORMAT_LETTER = True
+LOGIN_URL = "https://mailstudent.bmstu.ru/XIMSSLogin/"
+SAMOWARE_URL = URL("https://student.bmstu.ru/")
 
+COMMON_TIMEOUT = ClientTimeout(sock_read=HTTP_COMMON_TIMEOUT_SEC)
+LONGPOLL_TIMEOUT = ClientTimeout(
+    connect=HTTP_CONNECT_LONGPOLL_TIMEOUT_SEC,
+    total=HTTP_TOTAL_LONGPOLL_TIMEOUT_SEC,
+)
+FILE_LOAD_TIMEOUT = ClientTimeout(
+    sock_connect=HTTP_FILE_LOAD_TIMEOUT_SEC, sock_read=HTTP_FILE_LOAD_TIMEOUT_SEC
+)
 
-class UnauthorizedError(Exception):
-    pass
+# the time to the first longpoll is the startup target
+first_longpoll_sent = asyncio.Event()
 
+_connector: TCPConnector | None = None
+_http_session: ClientSession | None = None
 
-class SamowarePollingContext:
-    def __init__(
-        self,
-        session: str = "",
-        request_id: int = 0,
-        rand: int = 0,
-        command_id: int = 0,
-        ack_seq: int = 0,
-        cookies: SimpleCookie = SimpleCookie(),
-    ) -> None:
-        self.session = session
-        self.request_id = request_id
-        self.rand = rand
-        self.command_id = command_id
-        self.ack_seq = ack_seq
-        self.cookies = cookies
 
-    def make_next(
-        self,
-        session: str | None = None,
-        request_id: int | None = None,
-        rand: int | None = None,
-        command_id: int | None = None,
-        ack_seq: int | None = None,
-        cookies: SimpleCookie | None = None,
-    ) -> Self:
-        return SamowarePollingContext(
-            session=self.session if session is None else session,
-            command_id=self.command_id if command_id is None else command_id,
-            cookies=self.cookies if cookies is None else cookies,
-            ack_seq=self.ack_seq if ack_seq is None else ack_seq,
-            rand=self.rand if rand is None else rand,
-            request_id=self.request_id if request_id is None else request_id,
-        )
+class UnauthorizedError(Exception):
+    pass
 
 
 class MailHeader:
@@ -77,6 +109,8 @@ class MailHeader:
         from_mail: str,
         from_name: str,
         subject: str,
+        message_id: str | None = None,
+        size: int = 0,
     ) -> None:
         self.uid = uid
         self.flags = flags
@@ -86,13 +120,144 @@ class MailHeader:
         self.from_mail = from_mail
         self.from_name = from_name
         self.subject = subject
+        self.message_id = message_id
+        self.size = size
+
+
+class ByteBudget:
+    """
+    Counts the attachment bytes which are downloaded but not sent yet.
+    Downloads are never blocked by the budget, instead pollers wait
+    before fetching new mails while the budget is exceeded.
+    """
+
+    def __init__(self, limit: int) -> None:
+        self.limit = limit
+        self.used = 0
+        self.released = asyncio.Event()
+
+    def add(self, amount: int) -> None:
+        self.used += amount
+        metrics.attachments_in_flight_bytes_metric.set(self.used)
+
+    def release(self, amount: int) -> None:
+        self.used -= amount
+        metrics.attachments_in_flight_bytes_metric.set(self.used)
+        self.released.set()
+
+    async def wait_below_limit(self) -> None:
+        while self.used >= self.limit:
+            log.debug(f"attachments budget is exceeded: {self.used} bytes")
+            self.released.clear()
+            await self.released.wait()
+
+
+attachments_budget = ByteBudget(env.get_attachments_in_flight_limit())
+attachment_download_slots = asyncio.Semaphore(ATTACHMENT_DOWNLOADS_LIMIT)
+
+
+class Attachment:
+    """
+    An attachment which is fetched from Samoware when it is sent,
+    or up front when the mail is shared through the mail cache.
+    The first stream pipes the response body and keeps a copy in a spool
+    (memory while small, a temporary file when grows), so a retry can
+    reread the buffered copy instead of downloading the file again.
+    The same attachment may be shared by the mails of several users,
+    so it is reference counted and streamed by one reader at a time.
+    """
+
+    def __init__(self, client: "SamowareClient", url: str, name: str) -> None:
+        self.client = client
+        self.url = url
+        self.name = name
+        self.size = 0
+        self.is_complete = False
+        self.digest: str | None = None
+        self.file = SpooledTemporaryFile(max_size=ATTACHMENT_SPOOL_MEMORY_SIZE)
+        self.hash = hashlib.sha256()
+        self.refs = 1
+        self.lock = asyncio.Lock()
+
+    def acquire(self) -> "Attachment":
+        self.refs += 1
+        return self
+
+    def write(self, chunk: bytes) -> None:
+        self.file.write(chunk)
+        self.hash.update(chunk)
+        self.size += len(chunk)
+        attachments_budget.add(len(chunk))
+
+    def reset(self) -> None:
+        self.file.seek(0)
+        self.file.truncate()
+        self.hash = hashlib.sha256()
+        attachments_budget.release(self.size)
+        self.size = 0
+
+    async def stream(self) -> AsyncIterator[bytes]:
+        async with self.lock:
+            if self.is_complete:
+                self.file.seek(0)
+                while chunk := self.file.read(ATTACHMENT_CHUNK_SIZE):
+                    yield chunk
+                return
+
+            self.reset()
+            async with attachment_download_slots:
+                async with self.client.get_http_session().get(
+                    self.url, timeout=FILE_LOAD_TIMEOUT
+                ) as response:
+                    metrics.samoware_response_status_code_metric.labels(
+                        sc=response.status
+                    ).inc()
+                    await check_response(response, "getAttachment")
+                    async for chunk in response.content.iter_chunked(
+                        ATTACHMENT_CHUNK_SIZE
+                    ):
+                        self.write(chunk)
+                        yield chunk
+            self.digest = self.hash.hexdigest()
+            self.is_complete = True
+            log.debug(f"downloaded attachment {self.name} ({self.size} bytes)")
+
+    async def fetch(self) -> None:
+        # a complete spool is never downloaded again, nothing to read here
+        if self.is_complete:
+            return
+        async for _ in self.stream():
+            pass
+
+    def close(self) -> None:
+        self.refs -= 1
+        if self.refs > 0 or self.file.closed:
+            return
+        self.file.close()
+        attachments_budget.release(self.size)
+
+
+async def fetch_attachments(attachments: list[Attachment]) -> None:
+    await asyncio.gather(*(attachment.fetch() for attachment in attachments))
 
 
 class MailBody:
-    def __init__(self, text: str, attachments: list[tuple[HTTPResponse, str]]):
+    def __init__(self, text: str, attachments: list[Attachment]):
         self.text = text
         self.attachments = attachments
 
+    def acquire(self) -> "MailBody":
+        return MailBody(
+            self.text, [attachment.acquire() for attachment in self.attachments]
+        )
+
+    def get_size(self) -> int:
+        return len(self.text) + sum(attachment.size for attachment in self.attachments)
+
+    def close(self) -> None:
+        for attachment in self.attachments:
+            attachment.close()
+
 
 class Mail:
     def __init__(self, header: MailHeader, body: MailBody):
@@ -100,58 +265,219 @@ class Mail:
         self.body = body
 
 
-async def login(login: str, password: str) -> SamowarePollingContext | None:
-    log.debug(f"logging in for {login}")
+class PoolStat:
+    def __init__(self) -> None:
+        self.created = 0
+        self.reused = 0
 
-    url = "https://mailstudent.bmstu.ru/XIMSSLogin/"
-    params = {
-        "errorAsXML": "1",
-        "EnableUseCookie": "1",
-        "x2auth": "1",
-        "canUpdatePwd": "1",
-        "version": "6.1",
-        "userName": login,
-    }
-    if SESSION_TOKEN_PATTERN.match(password):
-        params["sessionid"] = password
-    else:
-        params["password"] = password
-    if not env.is_ip_check_enabled():
-        params["DisableIPWatch"] = "1"
+    def reuse_ratio(self) -> float:
+        total = self.created + self.reused
+        return self.reused / total if total > 0 else 0.0
 
-    async with ClientSession(
-        timeout=ClientTimeout(sock_read=HTTP_COMMON_TIMEOUT_SEC),
-    ) as http_session:
-        response = await http_session.get(url, params=params)
-        metrics.samoware_response_status_code_metric.labels(sc=response.status).inc()
 
-        tree = ET.fromstring(await response.text())
-        if tree.find("session") is None:
-            log.debug(f"logging in response ({login}) does not have session tag")
-            if (
-                tree.find("response").attrib["errorText"]
-                == "incorrect password or account name"
-            ):
-                raise UnauthorizedError
-            else:
-                raise HTTPError(
-                    url=url,
-                    code=response.status,
-                    msg=(await response.text()),
-                    hdrs=None,
-                    fp=None,
-                )
+pool_stat = PoolStat()
+
+
+async def on_connection_create_end(session, context, params) -> None:
+    pool_stat.created += 1
+    metrics.samoware_pool_connection_metric.labels(reused=False).inc()
+
+
+async def on_connection_reuseconn(session, context, params) -> None:
+    pool_stat.reused += 1
+    metrics.samoware_pool_connection_metric.labels(reused=True).inc()
+
+
+pool_trace_config = TraceConfig()
+pool_trace_config.on_connection_create_end.append(on_connection_create_end)
+pool_trace_config.on_connection_reuseconn.append(on_connection_reuseconn)
+
+
+def get_connector() -> TCPConnector:
+    global _connector
+    if _connector is None or _connector.closed:
+        _connector = make_connector()
+    return _connector
+
+
+def get_http_session() -> ClientSession:
+    global _http_session
+    if _http_session is None or _http_session.closed:
+        # a cookieless session for the requests which are not bound to a client
+        _http_session = make_http_session(DummyCookieJar())
+    return _http_session
+
+
+def make_http_session(cookie_jar: CookieJar | DummyCookieJar) -> ClientSession:
+    return ClientSession(
+        connector=get_connector(),
+        connector_owner=False,
+        cookie_jar=cookie_jar,
+        trace_configs=[pool_trace_config],
+    )
+
+
+async def close_http_pool() -> None:
+    global _connector, _http_session
+    if _http_session is not None and not _http_session.closed:
+        await _http_session.close()
+    _http_session = None
+    if _connector is not None and not _connector.closed:
+        await _connector.close()
+        log.info("samoware http pool is closed")
+    _connector = None
+
 
-        session = tree.find("session").attrib["urlID"]
+def make_connector() -> TCPConnector:
+    # the only ssl context for every connection: certificates are loaded once
+    # and the server can resume tls sessions of the kept alive connections
+    connector = TCPConnector(
+        limit=HTTP_POOL_LIMIT,
+        limit_per_host=env.get_http_pool_limit_per_host(),
+        ttl_dns_cache=HTTP_POOL_DNS_CACHE_TTL_SEC,
+        keepalive_timeout=HTTP_POOL_KEEPALIVE_TIMEOUT_SEC,
+        ssl=ssl.create_default_context(),
+    )
 
-        log.debug(f"successful login for {login}")
-        return SamowarePollingContext(session=session)
+    def idle_connections() -> int:
+        return sum(len(conns) for conns in connector._conns.values())
 
+    metrics.samoware_pool_connections_metric.labels(state="open").set_function(
+        lambda: len(connector._acquired) + idle_connections()
+    )
+    metrics.samoware_pool_connections_metric.labels(state="idle").set_function(
+        idle_connections
+    )
+    metrics.samoware_pool_reuse_ratio_metric.set_function(pool_stat.reuse_ratio)
 
-async def revalidate(login: str, session: str) -> SamowarePollingContext | None:
-    log.debug(f"revalidating session for {login}")
+    log.debug("creating samoware http pool")
+    return connector
 
-    url = "https://mailstudent.bmstu.ru/XIMSSLogin/"
+
+def is_outage_error(error: BaseException) -> bool:
+    if isinstance(error, HTTPError):
+        return error.code >= 500
+    return isinstance(error, (ClientError, TimeoutError))
+
+
+class SamowareHealth:
+    """
+    Circuit breaker shared by all the clients.
+    When most of the recent requests fail with connection errors,
+    timeouts or 5xx codes, the pollers are parked on one event and
+    a single probe checks Samoware with an exponential backoff. After
+    the recovery the pollers are released spread over a time window,
+    so the sessions are not resumed by a stampede.
+    """
+
+    def __init__(
+        self,
+        window_sec: float,
+        min_failures: int,
+        failure_ratio: float,
+        probe_delay_sec: float,
+        probe_max_delay_sec: float,
+        release_spread_sec: float,
+    ) -> None:
+        self.window_sec = window_sec
+        self.min_failures = min_failures
+        self.failure_ratio = failure_ratio
+        self.probe_delay_sec = probe_delay_sec
+        self.probe_max_delay_sec = probe_max_delay_sec
+        self.release_spread_sec = release_spread_sec
+        # (time, is_failure)
+        self.outcomes: deque[tuple[float, bool]] = deque()
+        self.failures = 0
+        self.available = asyncio.Event()
+        self.available.set()
+        self.probe_task: asyncio.Task | None = None
+
+    def is_available(self) -> bool:
+        return self.available.is_set()
+
+    def record_success(self) -> None:
+        self.record(False)
+
+    def record_error(self, error: BaseException) -> None:
+        if not is_outage_error(error):
+            return
+        self.record(True)
+        if self.is_available() and self.is_outage():
+            self.trip()
+
+    def record(self, is_failure: bool) -> None:
+        now = time.monotonic()
+        self.outcomes.append((now, is_failure))
+        self.failures += is_failure
+        while self.outcomes[0][0] < now - self.window_sec:
+            _, was_failure = self.outcomes.popleft()
+            self.failures -= was_failure
+
+    def is_outage(self) -> bool:
+        return (
+            self.failures >= self.min_failures
+            and self.failures >= len(self.outcomes) * self.failure_ratio
+        )
+
+    def trip(self) -> None:
+        log.warning(
+            f"samoware is unavailable: {self.failures} of {len(self.outcomes)} requests failed, pausing the polling"
+        )
+        self.available.clear()
+        metrics.samoware_outage_metric.set(1)
+        self.probe_task = asyncio.create_task(self.probe())
+
+    async def probe(self) -> None:
+        delay = self.probe_delay_sec
+        while True:
+            await asyncio.sleep(delay)
+            try:
+                async with get_http_session().get(
+                    SAMOWARE_URL, timeout=COMMON_TIMEOUT
+                ) as response:
+                    is_successful = response.status < 500
+            except (ClientError, TimeoutError):
+                is_successful = False
+            metrics.samoware_health_probe_metric.labels(
+                is_successful=is_successful
+            ).inc()
+            if is_successful:
+                break
+            delay = min(delay * 2, self.probe_max_delay_sec)
+            log.info(f"samoware is still unavailable, next probe in {delay}s")
+        log.info("samoware has recovered, resuming the polling")
+        self.outcomes.clear()
+        self.failures = 0
+        self.available.set()
+        metrics.samoware_outage_metric.set(0)
+
+    async def wait_available(self) -> None:
+        if self.is_available():
+            return
+        metrics.samoware_parked_pollers_metric.inc()
+        try:
+            await self.available.wait()
+        finally:
+            metrics.samoware_parked_pollers_metric.dec()
+        await asyncio.sleep(random.uniform(0, self.release_spread_sec))
+
+    async def stop(self) -> None:
+        if self.probe_task is not None:
+            self.probe_task.cancel()
+            await asyncio.gather(self.probe_task, return_exceptions=True)
+
+
+samoware_health = SamowareHealth(
+    SAMOWARE_HEALTH_WINDOW_SEC,
+    SAMOWARE_HEALTH_MIN_FAILURES,
+    SAMOWARE_HEALTH_FAILURE_RATIO,
+    SAMOWARE_HEALTH_PROBE_DELAY_SEC,
+    SAMOWARE_HEALTH_PROBE_MAX_DELAY_SEC,
+    SAMOWARE_HEALTH_RELEASE_SPREAD_SEC,
+)
+
+
+def make_login_params(login: str) -> dict[str, str]:
     params = {
         "errorAsXML": "1",
         "EnableUseCookie": "1",
@@ -159,389 +485,381 @@ async def revalidate(login: str, session: str) -> SamowarePollingContext | None:
         "canUpdatePwd": "1",
         "version": "6.1",
         "userName": login,
-        "sessionid": session,
     }
     if not env.is_ip_check_enabled():
         params["DisableIPWatch"] = "1"
+    return params
 
-    async with ClientSession(
-        timeout=ClientTimeout(sock_read=HTTP_COMMON_TIMEOUT_SEC),
-    ) as http_session:
-        response = await http_session.get(url, params=params)
-        metrics.samoware_response_status_code_metric.labels(sc=response.status).inc()
-
-        tree = ET.fromstring(await response.text())
-        if tree.find("session") is None:
-            log.debug(f"revalidation response ({login}) does not have session tag")
-            if (
-                tree.find("response").attrib["errorText"]
-                == "incorrect password or account name"
-            ):
-                raise UnauthorizedError
-            else:
-                raise HTTPError(
-                    url=url, code=response.status, msg=(await response.text())
-                )
-
-        new_session = tree.find("session").attrib["urlID"]
-        log.debug(f"successful revalidation {login}")
 
-        return SamowarePollingContext(session=new_session)
+async def measure_login_stage(stage: str, awaitable: Awaitable[T]) -> T:
+    start = time.perf_counter()
+    try:
+        return await awaitable
+    finally:
+        metrics.login_stage_duration_metric.labels(stage=stage).observe(
+            time.perf_counter() - start
+        )
 
 
-async def longpoll_updates(
-    context: SamowarePollingContext,
-) -> tuple[str, SamowarePollingContext]:
-    async with ClientSession(
-        timeout=ClientTimeout(
-            connect=HTTP_CONNECT_LONGPOLL_TIMEOUT_SEC,
-            total=HTTP_TOTAL_LONGPOLL_TIMEOUT_SEC,
-        )
-    ) as http_session:
-        url = f"https://student.bmstu.ru/Session/{context.session}/?ackSeq={context.ack_seq}&maxWait=20&random={context.rand}"
-        response = await http_session.get(
-            url=url,
-            cookies=context.cookies,
+async def check_response(response: ClientResponse, method_name: str) -> None:
+    if response.status == 550:
+        log.warning(
+            f"received 550 code in {method_name} - Samoware Unauthorized. response: {await response.text()}"
         )
-
-        metrics.samoware_response_status_code_metric.labels(sc=response.status).inc()
+        raise UnauthorizedError
+    if response.status != 200:
         response_text = await response.text()
-        log.debug(
-            f"samoware longpoll response code: {response.status}, text: {response_text}"
+        log.error(
+            f"received non 200 code in {method_name}: {response.status}. response: {response_text}"
         )
-        if response.status == 550:
-            log.warning(
-                f"received 550 code in longPollUpdates - Samoware Unauthorized. response: {response_text}"
-            )
-            raise UnauthorizedError
-        if response.status != 200:
-            log.error(
-                f"received non 200 code in longPollUpdates: {response.status}. response: {response_text}"
-            )
-            raise HTTPError(url=url, code=response.status, msg=(await response.text()))
-        tree = ET.fromstring(response_text)
-        ack_seq = context.ack_seq
-        if "respSeq" in tree.attrib:
-            ack_seq = int(tree.attrib["respSeq"])
-        return (
-            response_text,
-            context.make_next(ack_seq=ack_seq, rand=context.rand + 1),
+        raise HTTPError(
+            url=str(response.url),
+            code=response.status,
+            msg=response_text,
+            hdrs=None,
+            fp=None,
         )
 
 
-async def get_new_mails(
-    context: SamowarePollingContext,
-) -> tuple[list[MailHeader], SamowarePollingContext]:
-    async with ClientSession(
-        timeout=ClientTimeout(sock_read=HTTP_COMMON_TIMEOUT_SEC),
-        cookies=context.cookies,
-    ) as http_session:
-        url = f"https://student.bmstu.ru/Session/{context.session}/sync?reqSeq={context.request_id}&random={context.rand}"
-        response = await http_session.get(
-            url=url,
-            data=f'<XIMSS><folderSync folder="INBOX-MM-1" limit="300" id="{context.command_id}"/></XIMSS>',
-            cookies=context.cookies,
-            timeout=HTTP_COMMON_TIMEOUT_SEC,
-        )
-        metrics.samoware_response_status_code_metric.labels(sc=response.status).inc()
-
-        if response.status == 550:
-            log.warning(
-                f"received 550 code in getInboxUpdates - Samoware Unauthorized. response: {await response.text()}"
-            )
-            raise UnauthorizedError
-        if response.status != 200:
-            log.error(
-                f"received non 200 code in getInboxUpdates: {response.status}. response: {await response.text()}"
-            )
-            raise HTTPError(
-                url=url, code=response.status, msg=(await response.text()), hdrs=None
+class SamowareClient:
+    def __init__(
+        self,
+        login: str,
+        session: str = "",
+        request_id: int = 0,
+        rand: int = 0,
+        command_id: int = 0,
+        ack_seq: int = 0,
+        cookies: SimpleCookie | None = None,
+    ) -> None:
+        self.username = login
+        self.session = session
+        self.request_id = request_id
+        self.rand = rand
+        self.command_id = command_id
+        self.ack_seq = ack_seq
+        # the cookie jar and the http session need a running event loop,
+        # so they are created on the first request
+        self.loaded_cookies = cookies
+        self.cookie_jar: CookieJar | None = None
+        self.http_session: ClientSession | None = None
+        self.pending_commands: list[ET.Element] = []
+
+    def get_http_session(self) -> ClientSession:
+        if self.http_session is None or self.http_session.closed:
+            if self.cookie_jar is None:
+                self.cookie_jar = CookieJar()
+                if self.loaded_cookies is not None:
+                    self.cookie_jar.update_cookies(self.loaded_cookies, SAMOWARE_URL)
+                    self.loaded_cookies = None
+            self.http_session = make_http_session(self.cookie_jar)
+        return self.http_session
+
+    def get_cookies(self) -> SimpleCookie:
+        if self.cookie_jar is None:
+            return (
+                self.loaded_cookies
+                if self.loaded_cookies is not None
+                else SimpleCookie()
             )
-        tree = ET.fromstring(await response.text())
-        mail_headers = []
-        for element in tree.findall("folderReport"):
-            log.debug("folderReport: " + str(ET.tostring(element, encoding="utf8")))
-            if element.attrib["mode"] == "added":
-                uid = element.attrib["UID"]
-                local_time = datetime.strptime(
-                    element.find("INTERNALDATE").attrib["localTime"], "%Y%m%dT%H%M%S"
-                )
-                utc_time = datetime.strptime(
-                    element.find("INTERNALDATE").text, "%Y%m%dT%H%M%SZ"
+        cookies = SimpleCookie()
+        for morsel in self.cookie_jar:
+            cookies[morsel.key] = morsel
+        return cookies
+
+    async def close(self) -> None:
+        if self.http_session is not None and not self.http_session.closed:
+            await self.http_session.close()
+        self.http_session = None
+
+    def reset(self, session: str) -> None:
+        self.session = session
+        self.request_id = 0
+        self.rand = 0
+        self.command_id = 0
+        self.ack_seq = 0
+        self.loaded_cookies = None
+        if self.cookie_jar is not None:
+            self.cookie_jar.clear()
+        # the queued commands belong to the previous session
+        self.pending_commands = []
+
+    def make_sync_url(self) -> str:
+        url = f"https://student.bmstu.ru/Session/{self.session}/sync?reqSeq={self.request_id}&random={self.rand}"
+        self.request_id += 1
+        self.rand += 1
+        return url
+
+    async def login(self, password: str) -> None:
+        log.debug(f"logging in for {self.username}")
+
+        params = make_login_params(self.username)
+        if SESSION_TOKEN_PATTERN.match(password):
+            params["sessionid"] = password
+        else:
+            params["password"] = password
+
+        self.reset(await measure_login_stage("session", self.request_session(params)))
+        log.debug(f"successful login for {self.username}")
+
+    async def revalidate(self) -> None:
+        log.debug(f"revalidating session for {self.username}")
+
+        params = make_login_params(self.username)
+        params["sessionid"] = self.session
+
+        self.reset(await measure_login_stage("session", self.request_session(params)))
+        log.debug(f"successful revalidation {self.username}")
+
+    async def request_session(self, params: dict[str, str]) -> str:
+        async with get_http_session().get(
+            LOGIN_URL, params=params, timeout=COMMON_TIMEOUT
+        ) as response:
+            metrics.samoware_response_status_code_metric.labels(
+                sc=response.status
+            ).inc()
+
+            response_text = await response.text()
+            tree = ET.fromstring(response_text)
+            if tree.find("session") is None:
+                log.debug(
+                    f"logging in response ({self.username}) does not have session tag"
                 )
-                flags = element.find("FLAGS").text
-                from_mail = element.find("E-From").text
-                if "realName" in element.find("E-From").attrib:
-                    from_name = element.find("E-From").attrib["realName"]
-                else:
-                    from_name = element.find("E-From").text
                 if (
-                    element.find("Subject") is not None
-                    and element.find("Subject").text is not None
+                    tree.find("response").attrib["errorText"]
+                    == "incorrect password or account name"
                 ):
-                    subject = html.escape(element.find("Subject").text)
+                    raise UnauthorizedError
                 else:
-                    subject = "Письмо без темы"
-                to = []
-                for el in element.findall("E-To"):
-                    to_mail = el.text
-                    if "realName" in el.attrib:
-                        to_name = el.attrib["realName"]
-                    else:
-                        to_name = el.text
-                    to.append((to_mail, to_name))
-
-                mail_headers.append(
-                    MailHeader(
-                        flags=flags,
-                        from_mail=from_mail,
-                        from_name=from_name,
-                        local_time=local_time,
-                        subject=subject,
-                        recipients=to,
-                        uid=uid,
-                        utc_time=utc_time,
+                    raise HTTPError(
+                        url=LOGIN_URL,
+                        code=response.status,
+                        msg=response_text,
+                        hdrs=None,
+                        fp=None,
                     )
-                )
-        return (
-            mail_headers,
-            context.make_next(
-                request_id=context.request_id + 1,
-                rand=context.rand + 1,
-                command_id=context.command_id + 1,
-            ),
-        )
-
 
-async def set_session_info(context: SamowarePollingContext) -> SamowarePollingContext:
-    async with ClientSession(
-        timeout=ClientTimeout(sock_read=HTTP_COMMON_TIMEOUT_SEC),
-        cookies=context.cookies,
-    ) as http_session:
-        response = await http_session.post(
-            url=f"https://student.bmstu.ru/Session/{context.session}/sync?reqSeq={context.request_id}&random={context.rand}",
-            data='<XIMSS><prefsRead id="1"><name>Language</name></prefsRead></XIMSS>',
+            return tree.find("session").attrib["urlID"]
+
+    async def longpoll_updates(self) -> bool:
+        """
+        Waits for the server updates, returns whether new mails are reported.
+        """
+        url = f"https://student.bmstu.ru/Session/{self.session}/?ackSeq={self.ack_seq}&maxWait=20&random={self.rand}"
+        has_updates = False
+        first_longpoll_sent.set()
+        async with self.get_http_session().get(
+            url=url, timeout=LONGPOLL_TIMEOUT
+        ) as response:
+            metrics.samoware_response_status_code_metric.labels(
+                sc=response.status
+            ).inc()
+            log.debug(f"samoware longpoll response code: {response.status}")
+            await check_response(response, "longPollUpdates")
+            async for event in ximss.parse_response(response):
+                if isinstance(event, ximss.RespSeqEvent):
+                    self.ack_seq = event.resp_seq
+                elif (
+                    isinstance(event, ximss.FolderReportEvent)
+                    and event.folder == INBOX_FOLDER
+                    and event.mode == "notify"
+                ):
+                    has_updates = True
+        self.rand += 1
+        log.debug(f"samoware longpoll has updates: {has_updates}")
+        return has_updates
+
+    def queue_command(self, command: ET.Element) -> str:
+        command_id = str(self.command_id)
+        self.command_id += 1
+        command.set("id", command_id)
+        self.pending_commands.append(command)
+        return command_id
+
+    async def flush_events(self) -> AsyncIterator[ximss.XimssEvent]:
+        """
+        Sends all queued XIMSS commands in one sync request
+        and yields the response messages as they are parsed.
+        """
+        if len(self.pending_commands) == 0:
+            return
+        commands = self.pending_commands
+        self.pending_commands = []
+        envelope = ET.Element("XIMSS")
+        envelope.extend(commands)
+        session = self.session
+        is_accepted = False
+        try:
+            async with self.get_http_session().post(
+                url=self.make_sync_url(),
+                data=ET.tostring(envelope, encoding="unicode"),
+                timeout=COMMON_TIMEOUT,
+            ) as response:
+                metrics.samoware_response_status_code_metric.labels(
+                    sc=response.status
+                ).inc()
+                await check_response(response, "sync")
+                is_accepted = True
+                async for event in ximss.parse_response(response):
+                    if isinstance(event, ximss.ResponseEvent) and event.error_text:
+                        log.warning(
+                            f"samoware command {event.command_id} for {self.username} failed: {event.error_text}"
+                        )
+                    yield event
+        finally:
+            # the rejected marks go with the next sync of the same session,
+            # the other commands are queued again by their callers
+            if not is_accepted and self.session == session:
+                self.pending_commands[:0] = [
+                    command for command in commands if command.tag in REQUEUED_COMMANDS
+                ]
+
+    async def flush(self) -> None:
+        async for _ in self.flush_events():
+            pass
+
+    async def get_new_mails(self) -> list[MailHeader]:
+        command_id = self.queue_command(
+            ET.Element("folderSync", folder=INBOX_FOLDER, limit="300")
         )
-        metrics.samoware_response_status_code_metric.labels(sc=response.status).inc()
-
-        await http_session.post(
-            f"https://student.bmstu.ru/Session/{context.session}/sessionadmin.wcgp",
+        mail_headers = []
+        async for event in self.flush_events():
+            if (
+                isinstance(event, ximss.FolderReportEvent)
+                and event.command_id in (command_id, None)
+                and event.mode == "added"
+            ):
+                mail_headers.append(parse_mail_header(event.element))
+        return mail_headers
+
+    async def setup_session(self) -> None:
+        """
+        Prepares a new session: the XIMSS setup commands go in one sync
+        request. The session info is sent after it, since the sync
+        refills the session cookies.
+        """
+        prefs_read = ET.Element("prefsRead")
+        ET.SubElement(prefs_read, "name").text = "Language"
+        self.queue_command(prefs_read)
+        self.queue_open_inbox()
+        await measure_login_stage("setup_commands", self.flush())
+        await measure_login_stage("session_info", self.set_session_info())
+
+    async def set_session_info(self) -> None:
+        async with self.get_http_session().post(
+            f"https://student.bmstu.ru/Session/{self.session}/sessionadmin.wcgp",
             data={
                 "op": "setSessionInfo",
                 "paramType": "json",
                 "param": '{"platform":"Linux x86_64","clientName":"hSamoware","browser":"Firefox 122"}',
-                "session": context.session,
+                "session": self.session,
             },
+            timeout=COMMON_TIMEOUT,
+        ) as response:
+            # the answer is not checked, the session works without the info
+            metrics.samoware_response_status_code_metric.labels(
+                sc=response.status
+            ).inc()
+
+    def queue_open_inbox(self) -> None:
+        self.queue_command(ET.Element("listKnownValues"))
+        self.queue_command(ET.Element("mailboxList", filter="%", pureFolder="yes"))
+        self.queue_command(ET.Element("mailboxList", filter="%/%", pureFolder="yes"))
+        folder_open = ET.Element(
+            "folderOpen",
+            mailbox="INBOX",
+            sortField="INTERNALDATE",
+            sortOrder="desc",
+            folder=INBOX_FOLDER,
         )
-        return context.make_next(
-            cookies=response.cookies,
-            request_id=context.request_id + 1,
-            rand=context.rand + 1,
+        for field in INBOX_FIELDS:
+            ET.SubElement(folder_open, "field").text = field
+        self.queue_command(folder_open)
+        self.queue_command(
+            ET.Element("setSessionOption", name="reportMailboxChanges", value="yes")
         )
 
-
-async def open_inbox(context: SamowarePollingContext) -> SamowarePollingContext:
-    url = f"https://student.bmstu.ru/Session/{context.session}/sync?reqSeq={context.request_id}&random={context.rand}"
-    data = f"""<XIMSS>
-            <listKnownValues id="{context.command_id}"/>
-            <mailboxList filter="%" pureFolder="yes" id="{context.command_id + 1}"/>
-            <mailboxList filter="%/%" pureFolder="yes" id="{context.command_id + 2}"/>
-            <folderOpen mailbox="INBOX" sortField="INTERNALDATE" sortOrder="desc" folder="INBOX-MM-1" id="{context.command_id + 3}">
-                <field>FLAGS</field>
-                <field>E-From</field>
-                <field>Subject</field>
-                <field>Pty</field>
-                <field>Content-Type</field>
-                <field>INTERNALDATE</field>
-                <field>SIZE</field>
-                <field>E-To</field>
-                <field>E-Cc</field>
-                <field>E-Reply-To</field>
-                <field>X-Color</field>
-                <field>Disposition-Notification-To</field>
-                <field>X-Request-DSN</field>
-                <field>References</field>
-                <field>Message-ID</field>
-            </folderOpen>
-            <setSessionOption name="reportMailboxChanges" value="yes" id="{context.command_id + 4}"/>
-        </XIMSS>"""
-    async with ClientSession(
-        timeout=ClientTimeout(sock_read=HTTP_COMMON_TIMEOUT_SEC),
-        cookies=context.cookies,
-    ) as http_session:
-        response = await http_session.get(url, data=data)
-        metrics.samoware_response_status_code_metric.labels(sc=response.status).inc()
-
-        if response.status == 550:
-            log.error(
-                f"received 550 code in openInbox - Samoware Unauthorized. response: {await response.text()}"
-            )
-            raise UnauthorizedError
-        if response.status != 200:
-            log.error(
-                f"received non 200 code in openInbox: {response.status}. response: {await response.text()}"
-            )
-            raise HTTPError(
-                url=url, code=response.status, msg=(await response.text()), hdrs=None
-            )
-
-        return context.make_next(
-            request_id=context.request_id + 1,
-            rand=context.rand + 1,
-            command_id=context.command_id + 5,
-        )
-
-
-async def get_mail_body_by_id(context: SamowarePollingContext, uid: str) -> MailBody:
-    url = f"https://student.bmstu.ru/Session/{context.session}/FORMAT/Samoware/INBOX-MM-1/{uid}"
-    async with ClientSession(
-        timeout=ClientTimeout(sock_read=HTTP_COMMON_TIMEOUT_SEC),
-        cookies=context.cookies,
-    ) as http_session:
-        response = await http_session.get(url)
-        metrics.samoware_response_status_code_metric.labels(sc=response.status).inc()
-
-        if response.status == 550:
-            log.error(
-                f"received 550 code in getMailBodyById - Samoware Unauthorized\nresponse: {await response.text()}"
-            )
-            raise UnauthorizedError
-        if response.status != 200:
-            log.error(
-                f"received non 200 code in getMailBodyById: {response.status}\nresponse: {await response.text()}"
-            )
-            raise HTTPError(
-                url=url, code=response.status, msg=(await response.text()), hdrs=None
-            )
-        tree = bs.BeautifulSoup((await response.text()), "html.parser")
-        mailBodiesHtml = tree.findAll("div", {"class": "samoware-RFC822-body"})
-
-        text = ""
-        for mailBodyHtml in mailBodiesHtml:
-            log.debug("mail body: " + str(mailBodyHtml.encode()))
-            foundTextBeg = False
-            for element in mailBodyHtml.children:
-                if (
-                    isinstance(element, bs.Tag)
-                    and element.has_attr("class")
-                    and "textBeg" in element["class"]
-                ):
-                    foundTextBeg = True
-                    log.debug("found textBeg")
-                if (
-                    isinstance(element, bs.Tag)
-                    and element.has_attr("class")
-                    and "textEnd" in element["class"]
-                ):
-                    log.debug("found textEnd")
-                    break
-                if foundTextBeg:
-                    text += html_element_to_text(element)
-
-        text = re.sub(r"(\r)+", "\r", text).strip()
-        text = re.sub(r"(\n)+", "\n", text).strip()
-        text = text.replace("\r", "\n\n")
-        if AGGRESSIVE_FORMAT_LETTER:
-            text = text.replace("\n\xa0\n", "\n\n")
-        text = re.sub(r"(\n){2,}", "\n\n", text).strip()
-
-        attachments = []
-        for attachment_html in tree.find_all("cg-message-attachment"):
-            attachment_url = (
-                "https://student.bmstu.ru" + attachment_html["attachment-ref"]
-            )
-            file = await (
-                await http_session.get(
-                    attachment_url,
-                    timeout=HTTP_FILE_LOAD_TIMEOUT_SEC,
-                )
-            ).read()
-            name = attachment_html["attachment-name"]
-            attachments.append((file, name))
-        return MailBody(text, attachments)
-
-
-async def mark_as_read(
-    context: SamowarePollingContext, uid: str
-) -> SamowarePollingContext:
-    url = f"https://student.bmstu.ru/Session/{context.session}/sync?reqSeq={context.request_id}&random={context.rand}"
-    data = f'<XIMSS><messageMark flags="Read" folder="INBOX-MM-1" id="{context.command_id}"><UID>{uid}</UID></messageMark></XIMSS>'
-    async with ClientSession(
-        timeout=ClientTimeout(sock_read=HTTP_COMMON_TIMEOUT_SEC),
-        cookies=context.cookies,
-    ) as http_session:
-        response = await http_session.post(url=url, data=data)
-        metrics.samoware_response_status_code_metric.labels(sc=response.status).inc()
-
-        if response.status == 550:
-            log.error(
-                f"received 550 code in mark_as_read - Samoware Unauthorized\nresponse: {await response.text()}"
-            )
-            raise UnauthorizedError
-        if response.status != 200:
-            log.error(
-                f"received non 200 code in mark_as_read: {response.status}\nresponse: {await response.text()}"
-            )
-            raise HTTPError(
-                url=url, code=response.status, msg=(await response.text()), hdrs=None
-            )
-        return context.make_next(
-            request_id=context.request_id + 1,
-            rand=context.rand + 1,
-            command_id=context.command_id + 1,
-        )
-
-
-def html_element_to_text(element):
-    log.debug(f"converting html element to text: {element}")
-    if isinstance(element, bs.NavigableString):
-        return html.escape(
-            re.sub(
-                r" +",
-                " ",
-                str(element).replace("\r", "").strip("\n").replace("\n", " "),
-            )
-        )
-    elif isinstance(element, bs.Tag):
-        if element.name == "a" and "href" in element.attrs:
-            href = element["href"]
-            text = f'<a href="{href}">'
-            for child in element.children:
-                text += html_element_to_text(child)
-            text += "</a>"
-            return text
-        elif element.name == "style":
-            return ""
-        elif element.name == "br":
-            return "\n"
-        elif element.name == "hr":
-            return "\n----------\n"
-        elif element.name == "p":
-            text = ""
-            for child in element.children:
-                text += html_element_to_text(child)
-            return "\r" + text + "\r"
-        elif element.name == "div":
-            text = ""
-            for child in element.children:
-                text += html_element_to_text(child)
-            return "\n" + text + "\n"
-        elif element.name == "li":
-            text = ""
-            for child in element.children:
-                text += html_element_to_text(child)
-            return text + "\n"
-        elif element.name == "blockquote":
-            text = ""
-            for child in element.children:
-                text += html_element_to_text(child)
-            return "<blockquote>" + text.strip() + "</blockquote>"
-        else:
-            text = ""
-            for child in element.children:
-                text += html_element_to_text(child)
-            return text
-
-
-def has_updates(response: str) -> bool:
-    return '<folderReport folder="INBOX-MM-1" mode="notify"/>' in response
+    async def get_mail_body_by_id(self, uid: str) -> MailBody:
+        # backpressure: do not fetch new attachments while too many are unsent
+        await attachments_budget.wait_below_limit()
+        url = f"https://student.bmstu.ru/Session/{self.session}/FORMAT/Samoware/INBOX-MM-1/{uid}"
+        async with self.get_http_session().get(url, timeout=COMMON_TIMEOUT) as response:
+            metrics.samoware_response_status_code_metric.labels(
+                sc=response.status
+            ).inc()
+            await check_response(response, "getMailBodyById")
+            response_text = await response.text()
+        rendered_mail = await mail_renderer.render_mail_async(response_text)
+
+        attachments = [
+            Attachment(self, "https://student.bmstu.ru" + attachment_ref, name)
+            for attachment_ref, name in rendered_mail.attachments
+        ]
+        return MailBody(rendered_mail.text, attachments)
+
+    def queue_mark_as_read(self, uids: list[str]) -> None:
+        message_mark = ET.Element("messageMark", flags="Read", folder=INBOX_FOLDER)
+        for uid in uids:
+            ET.SubElement(message_mark, "UID").text = uid
+        self.queue_command(message_mark)
+
+    async def validate_session(self) -> None:
+        """
+        Sends a noop command, raises UnauthorizedError if the session is dead.
+        """
+        self.queue_command(ET.Element("noop"))
+        await self.flush()
+
+
+def parse_ximss_time(value: str) -> datetime:
+    # "%Y%m%dT%H%M%S" with an optional "Z", strptime is too slow for folderSync
+    if not XIMSS_TIME_PATTERN.match(value):
+        raise ValueError(f"time data {value!r} does not match XIMSS format")
+    return datetime(
+        int(value[0:4]),
+        int(value[4:6]),
+        int(value[6:8]),
+        int(value[9:11]),
+        int(value[11:13]),
+        int(value[13:15]),
+    )
+
+
+def parse_mail_header(element: ET.Element) -> MailHeader:
+    flags = None
+    internal_date = None
+    from_element = None
+    subject = None
+    message_id = None
+    size = 0
+    to = []
+    for child in element:
+        tag = child.tag
+        if tag == "E-To":
+            to.append((child.text, child.get("realName", child.text)))
+        elif tag == "INTERNALDATE" and internal_date is None:
+            internal_date = child
+        elif tag == "FLAGS" and flags is None:
+            flags = child.text
+        elif tag == "E-From" and from_element is None:
+            from_element = child
+        elif tag == "Subject" and subject is None:
+            subject = child.text if child.text is not None else ""
+        elif tag == "Message-ID" and message_id is None:
+            message_id = child.text
+        elif tag == "SIZE" and child.text is not None:
+            size = int(child.text)
+
+    log.debug(f"folderReport for mail {element.get('UID')}")
+    return MailHeader(
+        flags=flags,
+        from_mail=from_element.text,
+        from_name=from_element.get("realName", from_element.text),
+        local_time=parse_ximss_time(internal_date.attrib["localTime"]),
+        subject=html.escape(subject) if subject else "Письмо без темы",
+        recipients=to,
+        uid=element.attrib["UID"],
+        utc_time=parse_ximss_time(internal_date.text),
+        message_id=message_id,
+        size=size,
+    )
@@ -1,38 +1,91 @@
 #!/bin/python3
 
+# the first import: the duration of the other imports is measured from it
+from start_time import START_TIME
+
 import logging.handlers
 from telegram_bot import TelegramBot
 from prometheus_client import start_http_server
 import asyncio
 
 import logging
+import os
 import signal
-
-from metrics import GATHER_METRIC_DELAY_SEC, clients_amount_metric, log_metric
-from const import DB_FOLDER_PATH, DB_PATH, LOGGER_FOLDER_PATH, LOGGER_PATH
+import sys
+import time
+
+from metrics import (
+    GATHER_METRIC_DELAY_SEC,
+    clients_amount_metric,
+    log_metric,
+)
+from const import (
+    DB_FOLDER_PATH,
+    DB_PATH,
+    IMPORTTIME_LOG_PATH,
+    LOGGER_FOLDER_PATH,
+    LOGGER_PATH,
+    PROFILE_STARTUP_ARG,
+    PROFILE_STARTUP_IMPORTS_AMOUNT,
+    PROFILE_STARTUP_LONGPOLL_TIMEOUT_SEC,
+)
 from database import Database
 import env
+from mail_cache import mail_cache
+import mail_renderer
+import samoware_api
 import util
 
 
 class Application:
+    def __init__(self, imports_duration: float, profile_startup: bool) -> None:
+        self.imports_duration = imports_duration
+        self.profile_startup = profile_startup
+
     async def start(self) -> None:
-        self.db = Database(DB_PATH)
-        self.db.initialize()
+        timer = util.PhaseTimer("startup")
+        timer.add("imports", self.imports_duration)
+        with timer.phase("mail renderer"):
+            mail_renderer.start_executor()
+        with timer.phase("database"):
+            self.db = Database(DB_PATH)
+            self.db.initialize()
         self.bot = TelegramBot(self.db)
-        await self.bot.start_bot()
+        await self.bot.start_bot(timer)
+        if self.profile_startup:
+            await self.wait_first_longpoll(timer)
+        timer.log()
         self.gathering_metric_task = asyncio.create_task(
             self.gather_clients_amount_metric()
         )
+        self.flushing_db_task = asyncio.create_task(self.flush_db_periodically())
         self.setupShutdown(asyncio.get_event_loop())
+        if self.profile_startup:
+            log_slowest_imports()
+            os.kill(os.getpid(), signal.SIGTERM)
+
+    async def wait_first_longpoll(self, timer: util.PhaseTimer) -> None:
+        with timer.phase("first longpoll"):
+            try:
+                await asyncio.wait_for(
+                    samoware_api.first_longpoll_sent.wait(),
+                    PROFILE_STARTUP_LONGPOLL_TIMEOUT_SEC,
+                )
+            except TimeoutError:
+                logging.warning("no longpoll has started, are there any clients?")
 
     def setupShutdown(self, event_loop: asyncio.AbstractEventLoop):
         async def shutdown(signal) -> None:
             logging.info(f"received exit signal {signal}")
-            logging.info("closing db connection")
-            self.db.close()
             self.gathering_metric_task.cancel()
+            self.flushing_db_task.cancel()
             await self.bot.stop_bot()
+            logging.info("closing db connection")
+            await self.db.close()
+            mail_cache.clear()
+            await samoware_api.samoware_health.stop()
+            await samoware_api.close_http_pool()
+            mail_renderer.shutdown_executor()
             logging.info("application has stopped successfully")
 
         for s in (signal.SIGHUP, signal.SIGTERM, signal.SIGINT):
@@ -40,27 +93,54 @@ class Application:
                 s, lambda s=s: asyncio.create_task(shutdown(s))
             )
 
+    async def flush_db_periodically(self):
+        interval = env.get_db_flush_interval()
+        while True:
+            await asyncio.sleep(interval)
+            try:
+                await self.db.flush()
+            except Exception:
+                logging.exception("can not flush the database")
+
     async def gather_clients_amount_metric(self):
         try:
             while self.db.is_open():
-                clients = self.db.get_all_clients_stat()
+                stat = await self.db.get_clients_stat()
                 for pswd, autoread in (
                     (x, y) for x in (True, False) for y in (True, False)
                 ):
                     clients_amount_metric.labels(pswd=pswd, autoread=autoread).set(
-                        len(
-                            list(
-                                filter(
-                                    lambda x: x[2] == pswd and x[3] == autoread, clients
-                                )
-                            )
-                        )
+                        stat.get((pswd, autoread), 0)
                     )
                 await asyncio.sleep(GATHER_METRIC_DELAY_SEC)
         except:
             pass
 
 
+def log_slowest_imports() -> None:
+    if not os.path.exists(IMPORTTIME_LOG_PATH):
+        return
+    imports = util.get_slowest_imports(
+        IMPORTTIME_LOG_PATH, PROFILE_STARTUP_IMPORTS_AMOUNT
+    )
+    logging.info(
+        "slowest imports: "
+        + ", ".join(
+            f"{module} {self_time / 1000:.1f}ms" for module, self_time in imports
+        )
+    )
+
+
+def restart_with_importtime() -> None:
+    # -X importtime reports to stderr, so it is redirected into a file
+    util.make_dir_if_not_exist(LOGGER_FOLDER_PATH)
+    importtime_file = os.open(
+        IMPORTTIME_LOG_PATH, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644
+    )
+    os.dup2(importtime_file, sys.stderr.fileno())
+    os.execv(sys.executable, [sys.executable, "-X", "importtime", *sys.argv])
+
+
 def setup_logger():
     LOGGER_LEVEL = logging.INFO
     if env.is_debug():
@@ -83,7 +163,8 @@ def setup_logger():
     logging.getLogger("root").addHandler(MetricsHandler())
 
 
-async def main() -> None:
+async def main(profile_startup: bool) -> None:
+    imports_duration = time.perf_counter() - START_TIME
     setup_logger()
     util.make_dir_if_not_exist(DB_FOLDER_PATH)
     if env.is_prometheus_metrics_server_enabled():
@@ -91,7 +172,7 @@ async def main() -> None:
         logging.info(f"starting the metrics server on {port} port...")
         start_http_server(port)
     logging.info("starting the application...")
-    app = Application()
+    app = Application(imports_duration, profile_startup)
     await app.start()
     await asyncio.gather(
         *[task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
@@ -99,4 +180,7 @@ async def main() -> None:
 
 
 if __name__ == "__main__":
-    asyncio.run(main())
+    profile_startup = PROFILE_STARTUP_ARG in sys.argv
+    if profile_startup and "importtime" not in sys._xoptions:
+        restart_with_importtime()
+    asyncio.run(main(profile_startup))
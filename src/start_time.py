@@ -0,0 +1,8 @@
+"""
+The moment the application started, for the imports phase of the startup.
+samowarium imports it before anything else.
+"""
+
+import time
+
+START_TIME = time.perf_counter()
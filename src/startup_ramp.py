@@ -0,0 +1,118 @@
+import asyncio
+from collections import Counter
+import logging as log
+import random
+import time
+
+from client_handler import (
+    LOGIN_GIVEN_UP,
+    LOGIN_SUCCESSFUL,
+    SESSION_NEEDS_RELOGIN,
+    SESSION_NEEDS_USER,
+    ClientHandler,
+)
+import metrics
+
+RELOGIN_FAILED = "relogin_failed"
+RELOGIN_DEFERRED = "relogin_deferred"
+RELOGGED_IN = "relogged_in"
+RELOGIN_STATES = {
+    LOGIN_SUCCESSFUL: RELOGGED_IN,
+    # the polling relogins it when samoware answers again
+    LOGIN_GIVEN_UP: RELOGIN_DEFERRED,
+}
+
+
+class StartupRamp:
+    """
+    Resumes the polling of the saved clients after a restart.
+    Every restored session is validated with a noop before its polling
+    starts, at a limited rate with a jitter and with a bounded amount of
+    the validations in flight, the clients with the oldest revalidation
+    first, since their sessions are the closest to expiring. The dead
+    sessions are logged in again through a separate bounded queue, so
+    a mass expiry does not turn into a burst of logins.
+    """
+
+    def __init__(
+        self,
+        rate: float,
+        jitter_sec: float,
+        concurrency: int,
+        relogin_concurrency: int,
+    ) -> None:
+        self.rate = rate
+        self.jitter_sec = jitter_sec
+        self.slots = asyncio.Semaphore(concurrency)
+        self.relogin_slots = asyncio.Semaphore(relogin_concurrency)
+        self.relogin_queue_size = 0
+        self.states: Counter[str] = Counter()
+        self.done = 0
+        self.total = 0
+
+    async def run(self, handlers: list[ClientHandler]) -> None:
+        handlers = sorted(handlers, key=lambda handler: handler.context.last_revalidate)
+        self.total = len(handlers)
+        metrics.startup_ramp_progress_metric.set(0 if self.total > 0 else 1)
+        log.info(f"resuming {self.total} handlers at {self.rate}/s")
+        start = time.monotonic()
+        tasks = []
+        try:
+            for index, handler in enumerate(handlers):
+                start_at = start + index / self.rate
+                delay = start_at + random.uniform(0, self.jitter_sec) - time.monotonic()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+                await self.slots.acquire()
+                tasks.append(asyncio.create_task(self.resume(handler)))
+            await asyncio.gather(*tasks)
+        finally:
+            for task in tasks:
+                task.cancel()
+        duration = time.monotonic() - start
+        metrics.startup_online_duration_metric.set(duration)
+        log.info(
+            f"restart summary: {self.total} sessions are online in {duration:.1f}s, "
+            + ", ".join(f"{state} {amount}" for state, amount in self.states.items())
+        )
+
+    async def resume(self, handler: ClientHandler) -> None:
+        is_started = False
+        try:
+            try:
+                # the client may have stopped while waiting for the ramp
+                if not handler.db.is_client_active(handler.context.telegram_id):
+                    return
+                state = await handler.warm_up()
+            finally:
+                self.slots.release()
+            if state == SESSION_NEEDS_RELOGIN:
+                state = RELOGIN_STATES.get(await self.relogin(handler), RELOGIN_FAILED)
+            self.states[state] += 1
+            metrics.startup_session_state_metric.labels(state=state).inc()
+            if state not in (SESSION_NEEDS_USER, RELOGIN_FAILED):
+                await handler.start_handling()
+                is_started = True
+        except Exception:
+            log.exception(
+                f"can not resume the handler of {handler.context.samoware_login}"
+            )
+        finally:
+            # a started polling closes the client itself
+            if not is_started:
+                await handler.context.samoware_client.close()
+            self.done += 1
+            metrics.startup_ramp_progress_metric.set(self.done / self.total)
+
+    async def relogin(self, handler: ClientHandler) -> str:
+        self.relogin_queue_size += 1
+        metrics.startup_relogin_queue_metric.set(self.relogin_queue_size)
+        try:
+            await self.relogin_slots.acquire()
+        finally:
+            self.relogin_queue_size -= 1
+            metrics.startup_relogin_queue_metric.set(self.relogin_queue_size)
+        try:
+            return await handler.relogin()
+        finally:
+            self.relogin_slots.release()
@@ -1,14 +1,38 @@
+from collections import deque
+from functools import partial
+import json
+import time
+from urllib.error import HTTPError
+from uuid import uuid4
+from aiohttp import ClientSession, ClientTimeout, MultipartWriter
 from telegram import Update, InputMediaDocument
 import telegram
 from telegram.ext import Application, CommandHandler, ContextTypes, CallbackQueryHandler
 import logging as log
-from typing import Optional
+from typing import Awaitable, Callable, Optional
 import asyncio
 from client_handler import ClientHandler
-from const import MARKDOWN_FORMAT, TELEGRAM_SEND_RETRY_DELAY_SEC
+from const import (
+    LOGIN_CONCURRENCY,
+    LOGIN_TIMEOUT_SEC,
+    MARKDOWN_FORMAT,
+    STARTUP_RAMP_JITTER_SEC,
+    STARTUP_RELOGIN_CONCURRENCY,
+    TELEGRAM_CHAT_BURST,
+    TELEGRAM_CHAT_RATE,
+    TELEGRAM_DELIVERY_QUEUE_SIZE,
+    TELEGRAM_GLOBAL_BURST,
+    TELEGRAM_GLOBAL_RATE,
+)
 from database import Database
 import env
+from login_queue import LoginQueue
+from samoware_api import Attachment, UnauthorizedError, fetch_attachments
 import metrics
+from retry import TELEGRAM_RETRY_POLICIES, Retry, RetryBudget, make_retry_budget
+from revalidation import revalidation_scheduler
+from startup_ramp import StartupRamp
+from util import PhaseTimer
 
 START_PROMPT = "Выдать доступ боту до почты :\n/login _логин_ _пароль_\n\nОтозвать доступ:\n/stop\n\nFAQ:\n/about"
 STOP_PROMPT = "Доступ отозван. Логин и сессия были удалены."
@@ -41,6 +65,9 @@ LOGIN_WRONG_FORMAT_PROMPT = (
     "Неверный формат использования команды:\n/login <i>логин</i> <i>пароль</i>"
 )
 WAIT_TO_AUTH_PROMPT = "Авторизация. Пожалуйста, подождите..."
+LOGIN_QUEUED_PROMPT = "Авторизация. Ваше место в очереди: {}. Пожалуйста, подождите..."
+LOGIN_IS_IN_PROGRESS_PROMPT = "Авторизация уже выполняется. Пожалуйста, подождите..."
+LOGIN_TIMEOUT_PROMPT = "Самовар не ответил вовремя. Попробуйте авторизоваться позже."
 SAVE_PASSWORD_PROMPT = (
     "Сохранить пароль? Подробнее о хранении и использовании паролей: /about"
 )
@@ -63,6 +90,180 @@ AUTOREAD_ON_CALLBACK = "AUTOREAD_ON"
 AUTOREAD_OFF_CALLBACK = "AUTOREAD_OFF"
 
 
+class TokenBucket:
+    def __init__(self, rate: float, capacity: float) -> None:
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated_at = time.monotonic()
+        self.paused_until = 0.0
+
+    def pause(self, delay: float) -> None:
+        self.paused_until = max(self.paused_until, time.monotonic() + delay)
+
+    async def acquire(self) -> None:
+        while True:
+            now = time.monotonic()
+            if now < self.paused_until:
+                await asyncio.sleep(self.paused_until - now)
+                continue
+            self.tokens = min(
+                self.capacity, self.tokens + (now - self.updated_at) * self.rate
+            )
+            self.updated_at = now
+            if self.tokens >= 1:
+                self.tokens -= 1
+                return
+            await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class Delivery:
+    def __init__(
+        self,
+        telegram_id: int,
+        message: str,
+        format: str | None,
+        attachments: Optional[list[Attachment]],
+        outbox_id: str | None = None,
+    ) -> None:
+        self.telegram_id = telegram_id
+        self.message = message
+        self.format = format
+        self.attachments = attachments
+        self.outbox_id = outbox_id if outbox_id is not None else uuid4().hex
+        self.enqueued_at = time.monotonic()
+        self.holds_slot = False
+
+    def get_attachments_info(self) -> list[dict] | None:
+        if self.attachments is None:
+            return None
+        return [
+            {
+                "url": attachment.url,
+                "name": attachment.name,
+                "digest": attachment.digest,
+            }
+            for attachment in self.attachments
+        ]
+
+    def close(self) -> None:
+        for attachment in self.attachments or []:
+            attachment.close()
+
+
+class ChatQueue:
+    def __init__(self) -> None:
+        self.deliveries: deque[Delivery] = deque()
+        self.bucket = TokenBucket(TELEGRAM_CHAT_RATE, TELEGRAM_CHAT_BURST)
+        self.idle = asyncio.Event()
+
+
+class DeliveryScheduler:
+    """
+    Outbound telegram messages.
+    Every chat has a FIFO queue which is delivered by its own task, the
+    Bot API calls of all chats share a global rate limit. The amount of
+    the queued messages is bounded, enqueue waits for a free slot.
+    """
+
+    def __init__(
+        self, send: Callable[[Delivery], Awaitable[None]], max_size: int
+    ) -> None:
+        self.send = send
+        self.global_bucket = TokenBucket(TELEGRAM_GLOBAL_RATE, TELEGRAM_GLOBAL_BURST)
+        self.chats: dict[int, ChatQueue] = {}
+        self.tasks: set[asyncio.Task] = set()
+        self.slots = asyncio.Semaphore(max_size)
+        self.size = 0
+        self.started = asyncio.Event()
+
+    def start(self) -> None:
+        self.started.set()
+
+    async def enqueue(self, delivery: Delivery) -> None:
+        await self.slots.acquire()
+        delivery.holds_slot = True
+        self.put(delivery)
+
+    def restore(self, delivery: Delivery) -> None:
+        """
+        Queues a message from the outbox without waiting for a free slot:
+        it is already loaded, and the queue is not delivered yet at startup.
+        """
+        self.put(delivery)
+
+    def put(self, delivery: Delivery) -> None:
+        self.size += 1
+        metrics.delivery_queue_depth_metric.set(self.size)
+        chat = self.chats.get(delivery.telegram_id)
+        if chat is None:
+            chat = ChatQueue()
+            self.chats[delivery.telegram_id] = chat
+            task = asyncio.create_task(self.deliver(delivery.telegram_id, chat))
+            self.tasks.add(task)
+            task.add_done_callback(self.tasks.discard)
+        chat.deliveries.append(delivery)
+
+    async def deliver(self, telegram_id: int, chat: ChatQueue) -> None:
+        try:
+            await self.started.wait()
+            while len(chat.deliveries) > 0:
+                delivery = chat.deliveries.popleft()
+                metrics.delivery_wait_metric.observe(
+                    time.monotonic() - delivery.enqueued_at
+                )
+                try:
+                    # the sender closes the attachments, even when cancelled
+                    await self.send(delivery)
+                except Exception:
+                    log.exception(f"can not deliver a message to {telegram_id}")
+                finally:
+                    self.release(delivery)
+        finally:
+            # the deliveries left after a cancel are never sent
+            while len(chat.deliveries) > 0:
+                delivery = chat.deliveries.popleft()
+                delivery.close()
+                self.release(delivery)
+            del self.chats[telegram_id]
+            chat.idle.set()
+
+    def release(self, delivery: Delivery) -> None:
+        if delivery.holds_slot:
+            self.slots.release()
+        self.size -= 1
+        metrics.delivery_queue_depth_metric.set(self.size)
+
+    async def throttle(self, telegram_id: int) -> None:
+        chat = self.chats.get(telegram_id)
+        if chat is not None:
+            await chat.bucket.acquire()
+        await self.global_bucket.acquire()
+
+    async def retry_after(self, telegram_id: int, delay: float) -> None:
+        """
+        Holds the sends to the chat which hit the flood control.
+        The other chats keep their pace, so the global bucket is not paused.
+        """
+        log.warning(f"telegram asks to wait {delay} seconds (chat {telegram_id})")
+        chat = self.chats.get(telegram_id)
+        if chat is not None:
+            chat.bucket.pause(delay)
+        else:
+            # a message which is sent outside of the queues waits by itself
+            await asyncio.sleep(delay)
+
+    async def wait_sent(self, telegram_id: int) -> None:
+        chat = self.chats.get(telegram_id)
+        if chat is not None:
+            await chat.idle.wait()
+
+    async def stop(self) -> None:
+        for task in self.tasks:
+            task.cancel()
+        await asyncio.gather(*self.tasks, return_exceptions=True)
+
+
 class TelegramBot:
     def __init__(self, db: Database) -> None:
         self.db = db
@@ -73,6 +274,14 @@ class TelegramBot:
             ("about", self.about_command),
         ]
         self.handlers: dict[int, ClientHandler] = {}
+        self.upload_session: ClientSession | None = None
+        self.ramp_task: asyncio.Task | None = None
+        self.retry_budgets: dict[int, RetryBudget] = {}
+        self.login_queue = LoginQueue(LOGIN_CONCURRENCY, LOGIN_TIMEOUT_SEC)
+        self.db.add_removal_listener(self.on_client_removed)
+        self.delivery = DeliveryScheduler(
+            self.send_delivery, TELEGRAM_DELIVERY_QUEUE_SIZE
+        )
 
     async def callback_query_handler(
         self, update: Update, context: ContextTypes.DEFAULT_TYPE
@@ -81,7 +290,7 @@ class TelegramBot:
         command = data[0]
         if command == SAVE_PSW_CALLBACK:
             password = data[1]
-            self.db.set_password(update.effective_user.id, password)
+            await self.db.set_password(update.effective_user.id, password)
             await self.send_message(
                 update.effective_user.id, PASSWORD_SAVED_PROMPT, MARKDOWN_FORMAT
             )
@@ -89,13 +298,13 @@ class TelegramBot:
         elif command == NO_SAVE_PSW_CALLBACK:
             log.info(f"password for user {update.effective_user.id} is not saved")
         elif command == AUTOREAD_ON_CALLBACK:
-            self.db.set_autoread(update.effective_user.id, True)
+            await self.db.set_autoread(update.effective_user.id, True)
             await self.send_message(
                 update.effective_user.id, AUTOREAD_ON_PROMPT, MARKDOWN_FORMAT
             )
             log.info(f"autoread for user {update.effective_user.id} is enabled")
         elif command == AUTOREAD_OFF_CALLBACK:
-            self.db.set_autoread(update.effective_user.id, False)
+            await self.db.set_autoread(update.effective_user.id, False)
             await self.send_message(
                 update.effective_user.id, AUTOREAD_OFF_PROMPT, MARKDOWN_FORMAT
             )
@@ -104,41 +313,77 @@ class TelegramBot:
             update.effective_chat.id, update.callback_query.message.message_id
         )
 
-    async def start_bot(self) -> None:
+    async def start_bot(self, timer: PhaseTimer) -> None:
         log.info("starting the bot...")
         log.info("loading handlers...")
-        for telegram_id, context in self.db.get_all_clients():
-            handler = await ClientHandler.make_from_context(
-                context, self.send_message, self.db
+        with timer.phase("handlers"):
+            for telegram_id, context in await self.db.get_all_clients():
+                handler = await ClientHandler.make_from_context(
+                    context, self.enqueue_message, self.db
+                )
+                self.handlers[telegram_id] = handler
+            # the undelivered messages go first, before the new mails of the ramp
+            await self.resume_outbox()
+            ramp = StartupRamp(
+                env.get_startup_ramp_rate(),
+                STARTUP_RAMP_JITTER_SEC,
+                env.get_startup_ramp_concurrency(),
+                STARTUP_RELOGIN_CONCURRENCY,
             )
-            await handler.start_handling()
-            self.handlers[telegram_id] = handler
+            self.ramp_task = asyncio.create_task(ramp.run(list(self.handlers.values())))
         log.info("handlers are loaded")
 
         log.info("connecting to telegram api...")
-        self.application = Application.builder().token(env.get_telegram_token()).build()
+        with timer.phase("telegram"):
+            self.application = (
+                # a slow login must not hold the commands of the other users
+                Application.builder()
+                .token(env.get_telegram_token())
+                .concurrent_updates(True)
+                .build()
+            )
 
-        for command, handler in self.commands:
-            self.application.add_handler(CommandHandler(command, handler))
-        self.application.add_handler(CallbackQueryHandler(self.callback_query_handler))
+            for command, handler in self.commands:
+                self.application.add_handler(CommandHandler(command, handler))
+            self.application.add_handler(
+                CallbackQueryHandler(self.callback_query_handler)
+            )
 
-        await self.application.initialize()
-        await self.application.start()
-        log.info("starting telegram polling...")
-        await self.application.updater.start_polling()
+            await self.application.initialize()
+            await self.application.start()
+            log.info("starting telegram polling...")
+            await self.application.updater.start_polling()
+        self.delivery.start()
+        revalidation_scheduler.start()
         log.info("application is online")
 
     async def stop_bot(self):
         log.info("shutting down handlers...")
+        if self.ramp_task is not None:
+            self.ramp_task.cancel()
+            await asyncio.gather(self.ramp_task, return_exceptions=True)
         await asyncio.gather(
             *[handler.stop_handling() for handler in self.handlers.values()]
         )
+        await self.delivery.stop()
+        await revalidation_scheduler.stop()
         log.info("shutting down the bot...")
         await self.application.updater.stop()
         await self.application.stop()
         await self.application.shutdown()
+        if self.upload_session is not None:
+            await self.upload_session.close()
         log.info("telegram bot is shutted down")
 
+    def on_client_removed(self, telegram_id: int) -> None:
+        handler = self.handlers.pop(telegram_id, None)
+        self.retry_budgets.pop(telegram_id, None)
+        # a handler which removes its own client finishes by itself
+        if handler is None or handler.polling_task is None:
+            return
+        if handler.polling_task is not asyncio.current_task():
+            handler.polling_task.cancel()
+
     async def start_command(
         self, update: Update, context: ContextTypes.DEFAULT_TYPE
     ) -> None:
@@ -151,8 +396,10 @@ class TelegramBot:
     ) -> None:
         log.debug(f"received /stop from {update.effective_user.id}")
         telegram_id = update.effective_user.id
-        await self.handlers[telegram_id].stop_handling()
-        self.db.remove_client(
+        handler = self.handlers.get(telegram_id)
+        if handler is not None:
+            await handler.stop_handling()
+        await self.db.remove_client(
             telegram_id
         )  # TODO: не удалять запись, а удалять только контекст и пароль
         metrics.incoming_commands_metric.labels(command_name="stop").inc()
@@ -169,14 +416,42 @@ class TelegramBot:
             )
             await update.message.reply_html(LOGIN_WRONG_FORMAT_PROMPT)
             return
-        wait_message = await update.message.reply_markdown(WAIT_TO_AUTH_PROMPT)
         telegram_id = update.effective_user.id
-        samoware_login = context.args[0]
-        samoware_password = context.args[1]
+        if self.login_queue.is_queued(telegram_id):
+            await update.message.reply_markdown(LOGIN_IS_IN_PROGRESS_PROMPT)
+            return
+        with self.login_queue.hold(telegram_id):
+            await self.login_user(update, context.args[0], context.args[1])
+
+    async def login_user(
+        self, update: Update, samoware_login: str, samoware_password: str
+    ) -> None:
+        telegram_id = update.effective_user.id
+        wait_message = await update.message.reply_markdown(WAIT_TO_AUTH_PROMPT)
         log.debug(f'client entered login "{samoware_login}" and password')
-        new_handler = await ClientHandler.make_new(
-            telegram_id, samoware_login, samoware_password, self.send_message, self.db
-        )
+
+        async def show_queue_position(position: int) -> None:
+            try:
+                await wait_message.edit_text(
+                    LOGIN_QUEUED_PROMPT.format(position), parse_mode=MARKDOWN_FORMAT
+                )
+            except telegram.error.TelegramError:
+                log.exception(f"can not show the login queue position to {telegram_id}")
+
+        try:
+            new_handler = await ClientHandler.make_new(
+                telegram_id,
+                samoware_login,
+                samoware_password,
+                self.enqueue_message,
+                self.db,
+                partial(self.login_queue.run, on_queued=show_queue_position),
+            )
+        except TimeoutError:
+            await update.message.reply_markdown(LOGIN_TIMEOUT_PROMPT)
+            new_handler = None
+        # the prompts below must follow the queued login messages
+        await self.delivery.wait_sent(telegram_id)
         if new_handler is not None:
             await new_handler.start_handling()
             self.handlers[telegram_id] = new_handler
@@ -234,22 +509,85 @@ class TelegramBot:
             ABOUT_PROMPT.format(env.get_profile(), env.get_version())
         )
 
+    async def enqueue_message(
+        self,
+        telegram_id: int,
+        message: str,
+        format: str | None = None,
+        attachments: Optional[list[Attachment]] = None,
+    ) -> None:
+        delivery = Delivery(telegram_id, message, format, attachments)
+        self.db.add_outbox_message(
+            delivery.outbox_id,
+            telegram_id,
+            message,
+            format,
+            delivery.get_attachments_info(),
+        )
+        await self.delivery.enqueue(delivery)
+
+    async def send_delivery(self, delivery: Delivery) -> None:
+        await self.send_message(
+            delivery.telegram_id,
+            delivery.message,
+            delivery.format,
+            delivery.attachments,
+        )
+        self.db.remove_outbox_message(delivery.outbox_id)
+
+    async def resume_outbox(self) -> None:
+        messages = await self.db.get_outbox_messages()
+        log.info(f"resuming {len(messages)} messages from the outbox")
+        for outbox_id, telegram_id, message, format, attachments_info in messages:
+            attachments = None
+            handler = self.handlers.get(telegram_id)
+            if attachments_info is not None and handler is not None:
+                attachments = []
+                for info in attachments_info:
+                    attachment = Attachment(
+                        handler.context.samoware_client, info["url"], info["name"]
+                    )
+                    attachment.digest = info["digest"]
+                    attachments.append(attachment)
+            self.delivery.restore(
+                Delivery(telegram_id, message, format, attachments, outbox_id)
+            )
+
     async def send_message(
         self,
         telegram_id: int,
         message: str,
         format: str | None = None,
-        attachments: Optional[list[tuple[bytes, str]]] = None,
+        attachments: Optional[list[Attachment]] = None,
+    ) -> None:
+        try:
+            await self.send_message_with_retries(
+                telegram_id, message, format, attachments
+            )
+        finally:
+            for attachment in attachments or []:
+                attachment.close()
+
+    async def send_message_with_retries(
+        self,
+        telegram_id: int,
+        message: str,
+        format: str | None = None,
+        attachments: Optional[list[Attachment]] = None,
     ) -> None:
         is_sent = False
         log.debug(f'sending message "{message}" to {telegram_id} ...')
         metrics.sent_message_metric.inc()
+        retry = Retry(
+            "send_message", TELEGRAM_RETRY_POLICIES, self.get_retry_budget(telegram_id)
+        )
         while not is_sent:
             try:
                 for shift in range(0, len(message), MAX_TELEGRAM_MESSAGE_LENGTH):
                     message_part = message[
                         shift : min(shift + MAX_TELEGRAM_MESSAGE_LENGTH, len(message))
                     ]
+                    await self.delivery.throttle(telegram_id)
                     await self.application.bot.send_message(
                         telegram_id, message_part, parse_mode=format
                     )
@@ -257,31 +595,175 @@ class TelegramBot:
                     await self.send_attachments(telegram_id, attachments)
                 is_sent = True
                 log.info(f"sent message to {telegram_id}")
+            except telegram.error.RetryAfter as error:
+                await self.delivery.retry_after(telegram_id, error.retry_after)
             except telegram.error.BadRequest as error:
                 log.exception("exception in send_message:\n" + str(error))
                 log.info("error is bad request. Not retrying")
                 break
             except Exception as error:
                 log.exception("exception in send_message:\n" + str(error))
+                delay = retry.next_delay(error)
                 log.info(
-                    f"retrying to send message for {telegram_id} in {TELEGRAM_SEND_RETRY_DELAY_SEC} seconds..."
+                    f"retrying to send message for {telegram_id} in {delay:.1f} seconds..."
                 )
-                await asyncio.sleep(TELEGRAM_SEND_RETRY_DELAY_SEC)
+                await asyncio.sleep(delay)
+
+    def get_retry_budget(self, telegram_id: int) -> RetryBudget:
+        if telegram_id not in self.retry_budgets:
+            self.retry_budgets[telegram_id] = make_retry_budget()
+        return self.retry_budgets[telegram_id]
 
     async def send_attachments(
-        self, telegram_id: int, attachments: Optional[list[tuple[bytes, str]]]
+        self, telegram_id: int, attachments: Optional[list[Attachment]]
     ):
-        media_group = []
-        for attachment in attachments:
-            (file, name) = attachment
-            media_group.append(InputMediaDocument(file, filename=name))
-        sent = False
         log.debug(
-            f"sending attachments ({[name for (_, name) in attachments]}) to {telegram_id} ..."
+            f"sending attachments ({[attachment.name for attachment in attachments]}) to {telegram_id} ..."
+        )
+        # files which were uploaded before are resent by their telegram file ids
+        file_ids = [
+            (
+                await self.db.get_telegram_file_id(attachment.digest)
+                if attachment.digest is not None
+                else None
+            )
+            for attachment in attachments
+        ]
+        uploads = [
+            attachment
+            for attachment, file_id in zip(attachments, file_ids)
+            if file_id is None
+        ]
+        if len(uploads) > 0 and not any(
+            attachment.is_complete for attachment in uploads
+        ):
+            try:
+                await self.send_attachments_streamed(telegram_id, attachments, file_ids)
+                log.info(f"sent attachments to {telegram_id}")
+                return
+            except telegram.error.BadRequest as error:
+                # the buffered copies would get the same answer
+                log.exception("exception in send_attachments:\n" + str(error))
+                if not await self.forget_file_ids(attachments, file_ids):
+                    log.info("error is bad request. Not retrying")
+                    return
+                log.info("file ids may be outdated. Retrying with uploads")
+                file_ids = [None] * len(attachments)
+            except Exception as error:
+                if isinstance(error, telegram.error.RetryAfter):
+                    await self.delivery.retry_after(telegram_id, error.retry_after)
+                log.warning(
+                    f"can not stream attachments to {telegram_id}, sending buffered copies: {error}"
+                )
+        await self.send_attachments_buffered(telegram_id, attachments, file_ids)
+
+    async def send_attachments_streamed(
+        self,
+        telegram_id: int,
+        attachments: list[Attachment],
+        file_ids: list[str | None],
+    ) -> None:
+        """
+        Pipes the attachments from Samoware into the multipart upload,
+        so only a few chunks of every file are held at once.
+        The streams keep a copy of what they have sent, retries reuse it.
+        """
+        streams = [
+            attachment.stream()
+            for attachment, file_id in zip(attachments, file_ids)
+            if file_id is None
+        ]
+        try:
+            with MultipartWriter("form-data") as form:
+                form.append(str(telegram_id)).set_content_disposition(
+                    "form-data", name="chat_id"
+                )
+                media = []
+                parts = []
+                for index, (attachment, file_id) in enumerate(
+                    zip(attachments, file_ids)
+                ):
+                    if file_id is not None:
+                        media.append({"type": "document", "media": file_id})
+                        continue
+                    media.append(
+                        {"type": "document", "media": f"attach://attachment{index}"}
+                    )
+                    parts.append((f"attachment{index}", attachment.name))
+                form.append(json.dumps(media)).set_content_disposition(
+                    "form-data", name="media"
+                )
+                for (name, filename), stream in zip(parts, streams):
+                    form.append(stream).set_content_disposition(
+                        "form-data", name=name, filename=filename
+                    )
+                await self.delivery.throttle(telegram_id)
+                async with self.get_upload_session().post(
+                    f"{self.application.bot.base_url}/sendMediaGroup", data=form
+                ) as response:
+                    result = await response.json()
+        finally:
+            for stream in streams:
+                await stream.aclose()
+        if not result.get("ok", False):
+            description = result.get("description", "unknown error")
+            if result.get("error_code") == 400:
+                raise telegram.error.BadRequest(description)
+            if "retry_after" in result.get("parameters", {}):
+                raise telegram.error.RetryAfter(result["parameters"]["retry_after"])
+            raise telegram.error.NetworkError(description)
+        await self.save_file_ids(
+            attachments,
+            file_ids,
+            [
+                message.get("document", {}).get("file_id")
+                for message in result.get("result", [])
+            ],
+        )
+
+    def get_upload_session(self) -> ClientSession:
+        if self.upload_session is None:
+            self.upload_session = ClientSession(
+                timeout=ClientTimeout(
+                    sock_connect=HTTP_FILE_SEND_TIMEOUT_SEC,
+                    sock_read=HTTP_FILE_SEND_TIMEOUT_SEC,
+                )
+            )
+        return self.upload_session
+
+    async def send_attachments_buffered(
+        self,
+        telegram_id: int,
+        attachments: list[Attachment],
+        file_ids: list[str | None],
+    ) -> None:
+        sent = False
+        retry = Retry(
+            "send_attachments",
+            TELEGRAM_RETRY_POLICIES,
+            self.get_retry_budget(telegram_id),
         )
         while not sent:
             try:
-                await self.application.bot.send_media_group(
+                await fetch_attachments(
+                    [
+                        attachment
+                        for attachment, file_id in zip(attachments, file_ids)
+                        if file_id is None
+                    ]
+                )
+                media_group = []
+                for attachment, file_id in zip(attachments, file_ids):
+                    if file_id is not None:
+                        media_group.append(InputMediaDocument(file_id))
+                        continue
+                    # shared attachments are read by several senders
+                    attachment.file.seek(0)
+                    media_group.append(
+                        InputMediaDocument(attachment.file, filename=attachment.name)
+                    )
+                await self.delivery.throttle(telegram_id)
+                messages = await self.application.bot.send_media_group(
                     telegram_id,
                     media_group,
                     read_timeout=HTTP_FILE_SEND_TIMEOUT_SEC,
@@ -289,13 +771,72 @@ class TelegramBot:
                 )
                 sent = True
                 log.info(f"sent attachments to {telegram_id}")
+                await self.save_file_ids(
+                    attachments,
+                    file_ids,
+                    [
+                        message.document.file_id if message.document else None
+                        for message in messages
+                    ],
+                )
+            except telegram.error.RetryAfter as error:
+                await self.delivery.retry_after(telegram_id, error.retry_after)
+            except (HTTPError, UnauthorizedError) as error:
+                # the attachment links are bound to the samoware session
+                log.exception("can not download attachments:\n" + str(error))
+                log.info("attachments are unavailable. Not retrying")
+                break
             except telegram.error.BadRequest as error:
                 log.exception("exception in send_attachments:\n" + str(error))
-                log.info("error is bad request. Not retrying")
-                break
+                if not await self.forget_file_ids(attachments, file_ids):
+                    log.info("error is bad request. Not retrying")
+                    break
+                log.info("file ids may be outdated. Retrying with uploads")
+                file_ids = [None] * len(attachments)
             except Exception as error:
                 log.exception("exception in send_attachments:\n" + str(error))
+                delay = retry.next_delay(error)
                 log.info(
-                    f"retrying to send attachments for {telegram_id} in {TELEGRAM_SEND_RETRY_DELAY_SEC} seconds..."
+                    f"retrying to send attachments for {telegram_id} in {delay:.1f} seconds..."
                 )
-                await asyncio.sleep(TELEGRAM_SEND_RETRY_DELAY_SEC)
+                await asyncio.sleep(delay)
+
+    async def forget_file_ids(
+        self, attachments: list[Attachment], file_ids: list[str | None]
+    ) -> bool:
+        """
+        Removes the file ids a rejected media group was sent with,
+        returns False if it was a plain upload.
+        """
+        known_digests = [
+            attachment.digest
+            for attachment, file_id in zip(attachments, file_ids)
+            if file_id is not None
+        ]
+        if len(known_digests) == 0:
+            return False
+        await self.db.remove_telegram_file_ids(known_digests)
+        return True
+
+    async def save_file_ids(
+        self,
+        attachments: list[Attachment],
+        file_ids: list[str | None],
+        sent_file_ids: list[str | None],
+    ) -> None:
+        new_file_ids = [
+            (attachment.digest, sent_file_id)
+            for attachment, file_id, sent_file_id in zip(
+                attachments, file_ids, sent_file_ids
+            )
+            if file_id is None
+            and sent_file_id is not None
+            and attachment.digest is not None
+        ]
+        uploaded = sum(1 for file_id in file_ids if file_id is None)
+        metrics.sent_attachment_metric.labels(uploaded=True).inc(uploaded)
+        metrics.sent_attachment_metric.labels(uploaded=False).inc(
+            len(file_ids) - uploaded
+        )
+        if len(new_file_ids) > 0:
+            await self.db.add_telegram_file_ids(new_file_ids)
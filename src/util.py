@@ -1,12 +1,14 @@
-from http.client import HTTPResponse
+from contextlib import contextmanager
 import os
-import subprocess
-from typing import Awaitable, Callable, Optional
+from sqlite3 import OperationalError, connect
+import time
+from typing import Awaitable, Callable, Iterator, Optional
 import logging as log
 
-MessageSender = Callable[
-    [int, str, str, Optional[list[tuple[HTTPResponse, str]]]], Awaitable[None]
-]
+from const import MIGRATIONS_FOLDER_PATH
+from samoware_api import Attachment
+
+MessageSender = Callable[[int, str, str, Optional[list[Attachment]]], Awaitable[None]]
 
 
 def make_dir_if_not_exist(path):
@@ -15,6 +17,87 @@ def make_dir_if_not_exist(path):
         os.makedirs(path)
 
 
-def run_migrations():
-    log.debug("running migrations...")
-    subprocess.run(["yoyo", "apply", "-b"])
+class PhaseTimer:
+    """
+    Collects the durations of the named phases, e.g. of the startup.
+    """
+
+    def __init__(self, name: str) -> None:
+        self.name = name
+        self.phases: list[tuple[str, float]] = []
+
+    @contextmanager
+    def phase(self, name: str) -> Iterator[None]:
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.phases.append((name, time.perf_counter() - start))
+
+    def add(self, name: str, duration: float) -> None:
+        self.phases.append((name, duration))
+
+    def log(self) -> None:
+        total = sum(duration for _, duration in self.phases)
+        phases = ", ".join(f"{name} {duration:.3f}s" for name, duration in self.phases)
+        log.info(f"{self.name} took {total:.3f}s: {phases}")
+
+
+def get_slowest_imports(importtime_path: str, amount: int) -> list[tuple[str, int]]:
+    """
+    Parses the "-X importtime" output, returns the modules with
+    the largest self time in microseconds.
+    """
+    imports = []
+    with open(importtime_path, encoding="utf-8") as importtime_file:
+        for line in importtime_file:
+            if not line.startswith("import time:") or "self [us]" in line:
+                continue
+            self_time, _, module = line.removeprefix("import time:").split("|")
+            imports.append((module.strip(), int(self_time)))
+    return sorted(imports, key=lambda item: item[1], reverse=True)[:amount]
+
+
+def get_migration_ids() -> set[str]:
+    return {
+        file_name.removesuffix(".py")
+        for file_name in os.listdir(MIGRATIONS_FOLDER_PATH)
+        if file_name.endswith(".py") and not file_name.startswith("_")
+    }
+
+
+def get_applied_migration_ids(db_path: str) -> set[str]:
+    connection = connect(db_path)
+    try:
+        return {
+            migration_id
+            for (migration_id,) in connection.execute(
+                "SELECT migration_id FROM _yoyo_migration"
+            ).fetchall()
+        }
+    except OperationalError:
+        # the database is new, yoyo has not created its tables yet
+        return set()
+    finally:
+        connection.close()
+
+
+def run_migrations(db_path: str) -> None:
+    timer = PhaseTimer("migrations")
+    with timer.phase("check"):
+        pending = get_migration_ids() - get_applied_migration_ids(db_path)
+    if len(pending) == 0:
+        log.debug("database schema is up to date")
+        timer.log()
+        return
+
+    log.info(f"applying {len(pending)} migrations...")
+    with timer.phase("import"):
+        from yoyo import get_backend, read_migrations
+
+    with timer.phase("apply"):
+        backend = get_backend(f"sqlite:///{db_path}")
+        migrations = read_migrations(MIGRATIONS_FOLDER_PATH)
+        with backend.lock():
+            backend.apply_migrations(backend.to_apply(migrations))
+    timer.log()
@@ -0,0 +1,88 @@
+from typing import AsyncIterator, Iterator
+import xml.etree.ElementTree as ET
+
+from aiohttp import ClientResponse
+
+STREAM_CHUNK_SIZE = 16 * 1024
+
+
+class XimssEvent:
+    pass
+
+
+class RespSeqEvent(XimssEvent):
+    def __init__(self, resp_seq: int) -> None:
+        self.resp_seq = resp_seq
+
+
+class FolderReportEvent(XimssEvent):
+    def __init__(self, element: ET.Element) -> None:
+        self.element = element
+        self.command_id = element.get("id")
+        self.folder = element.get("folder")
+        self.mode = element.get("mode")
+        self.uid = element.get("UID")
+
+
+class ResponseEvent(XimssEvent):
+    def __init__(self, element: ET.Element) -> None:
+        self.command_id = element.get("id")
+        self.error_text = element.get("errorText")
+
+
+class ElementEvent(XimssEvent):
+    def __init__(self, element: ET.Element) -> None:
+        self.element = element
+        self.command_id = element.get("id")
+
+
+def make_event(element: ET.Element) -> XimssEvent:
+    if element.tag == "folderReport":
+        return FolderReportEvent(element)
+    if element.tag == "response":
+        return ResponseEvent(element)
+    return ElementEvent(element)
+
+
+class XimssStreamParser:
+    """
+    Incremental parser of the <XIMSS> documents.
+    Every top-level message is emitted as soon as it is closed and then
+    detached from the root, so the whole document is never kept in memory.
+    """
+
+    def __init__(self) -> None:
+        self.parser = ET.XMLPullParser(events=("start", "end"))
+        self.root: ET.Element | None = None
+        self.depth = 0
+
+    def feed(self, data: bytes | str) -> Iterator[XimssEvent]:
+        self.parser.feed(data)
+        return self.read_events()
+
+    def close(self) -> Iterator[XimssEvent]:
+        self.parser.close()
+        return self.read_events()
+
+    def read_events(self) -> Iterator[XimssEvent]:
+        for event, element in self.parser.read_events():
+            if event == "start":
+                self.depth += 1
+                if self.depth == 1:
+                    self.root = element
+                    if "respSeq" in element.attrib:
+                        yield RespSeqEvent(int(element.attrib["respSeq"]))
+                continue
+            self.depth -= 1
+            if self.depth == 1:
+                yield make_event(element)
+                self.root.remove(element)
+
+
+async def parse_response(response: ClientResponse) -> AsyncIterator[XimssEvent]:
+    parser = XimssStreamParser()
+    async for chunk in response.content.iter_chunked(STREAM_CHUNK_SIZE):
+        for event in parser.feed(chunk):
+            yield event
+    for event in parser.close():
+        yield event